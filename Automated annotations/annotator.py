@@ -2,10 +2,56 @@ import cv2
 import json
 import os
 import glob
+import hashlib
 import numpy as np
-import matplotlib.pyplot as plt
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 from sklearn.cluster import KMeans
 
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+def rle_counts(mask: np.ndarray) -> np.ndarray:
+    """COCO run-length counts of a boolean mask (column-major, first run is zeros)."""
+    flat = mask.ravel(order="F")
+    change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    boundaries = np.concatenate(([0], change, [flat.size]))
+    counts = np.diff(boundaries)
+    if flat.size and flat[0]:
+        counts = np.concatenate(([0], counts))
+    return counts
+
+
+def rle_counts_to_string(counts: np.ndarray) -> str:
+    """
+    COCO compressed-count string (as produced by pycocotools), computed for all
+    counts at once: each value is delta-coded against the count two runs back
+    and emitted as 5-bit groups with a continuation bit.
+    """
+    values = np.asarray(counts, dtype=np.int64).copy()
+    values[3:] -= np.asarray(counts, dtype=np.int64)[1:-2]
+
+    groups = []
+    active = np.ones(len(values), dtype=bool)
+    while active.any():
+        chunk = values & 0x1f
+        values = values >> 5
+        more = np.where(chunk & 0x10, values != -1, values != 0)
+        groups.append(np.where(active, (chunk | (more << 5)) + 48, 0))
+        active &= more
+
+    if not groups:
+        return ""
+    table = np.stack(groups, axis=1).astype(np.uint8)
+    return table[table != 0].tobytes().decode("ascii")
+
+
+def mask_bbox(mask: np.ndarray) -> list:
+    """[x, y, w, h] bounding box of the True pixels."""
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    return [int(cols[0]), int(rows[0]), int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1)]
+
+
 class ImageSegmenter:
 
     def __init__(self, image_path: str, num_clusters: int = 2):
@@ -61,33 +107,37 @@ class ImageSegmenter:
 
         if self.labels is None or self.centroids is None:
             raise ValueError("Clustering must be performed first.")
-        segmented_pixels = np.array([self.centroids[label] for label in self.labels])
-        self.segmented_img = segmented_pixels.reshape(self.img_rgb.shape).astype(np.uint8)
+        # Palette lookup: one uint8 color per cluster, indexed by the label array
+        palette = self.centroids.astype(np.uint8)
+        self.segmented_img = palette[self.labels].reshape(self.img_rgb.shape)
         print("Segmented image (centroid colors) created.")
     
     def create_cluster_images(self):
 
         if self.labels is None:
             raise ValueError("Clustering must be performed first.")
-        labels_2d = self.labels.reshape(self.img_rgb.shape[0], self.img_rgb.shape[1])
-        self.cluster_images = []
-        for i in range(self.num_clusters):
-            cluster_img = np.zeros_like(self.img_rgb)
-            cluster_img[labels_2d == i] = self.img_rgb[labels_2d == i]
-            self.cluster_images.append(cluster_img)
+        labels_2d = self.labels.reshape(self.img_rgb.shape[:2])
+        self.cluster_images = [
+            np.where((labels_2d == i)[..., np.newaxis], self.img_rgb, 0).astype(self.img_rgb.dtype)
+            for i in range(self.num_clusters)
+        ]
         print("Individual cluster images created.")
     
     def generate_semantic_segmentation_mask(self):
 
-        labels_2d = self.labels.reshape(self.img_rgb.shape[:2])
-        mask = np.zeros_like(labels_2d, dtype=np.uint8)
-        for i in range(self.num_clusters):
-            cat_id = 1 if self.semantic_labels[i] == "background" else 2
-            mask[labels_2d == i] = cat_id
-        return mask
+        # Category LUT indexed by cluster label: 1 = background, 2 = material
+        category_lut = np.array(
+            [1 if self.semantic_labels[i] == "background" else 2 for i in range(self.num_clusters)],
+            dtype=np.uint8,
+        )
+        return category_lut[self.labels].reshape(self.img_rgb.shape[:2])
     
-    def get_polygon_annotations(self, image_id: int):
-
+    def get_polygon_annotations(self, image_id: int, simplify_tolerance: float = 0.0):
+        """
+        Traces every category region as a polygon annotation. A positive
+        `simplify_tolerance` (in pixels) simplifies each contour with
+        Douglas-Peucker before it is stored.
+        """
         mask = self.generate_semantic_segmentation_mask()
         annotations = []
         # Process both categories: 1 (background) and 2 (material)
@@ -99,6 +149,8 @@ class ImageSegmenter:
                     continue
                 x, y, w, h = cv2.boundingRect(cnt)
                 area = cv2.contourArea(cnt)
+                if simplify_tolerance > 0:
+                    cnt = cv2.approxPolyDP(cnt, simplify_tolerance, True)
                 segmentation = cnt.flatten().tolist()
                 if len(segmentation) < 6:
                     continue
@@ -112,8 +164,47 @@ class ImageSegmenter:
                 }
                 annotations.append(annotation)
         return annotations
+
+    def get_rle_annotations(self, image_id: int, compressed: bool = True):
+        """
+        Encodes each category mask as one COCO RLE annotation instead of tracing
+        contours. Counts are column-major run lengths starting with a zero run;
+        `compressed=True` stores them as a COCO compressed-count string.
+        """
+        mask = self.generate_semantic_segmentation_mask()
+        height, width = mask.shape
+        annotations = []
+        for cat_id in [1, 2]:
+            cat_mask = mask == cat_id
+            area = int(np.count_nonzero(cat_mask))
+            if area == 0:
+                continue
+            counts = rle_counts(cat_mask)
+            annotations.append({
+                "image_id": image_id,
+                "category_id": cat_id,
+                "bbox": mask_bbox(cat_mask),
+                "area": area,
+                "segmentation": {
+                    "size": [height, width],
+                    "counts": rle_counts_to_string(counts) if compressed else counts.tolist(),
+                },
+                "iscrowd": 0
+            })
+        return annotations
+
+    def get_annotations(self, image_id: int, annotation_format: str = "polygon",
+                        simplify_tolerance: float = 0.0):
+        """Returns annotations in 'polygon', 'rle' (compressed counts) or 'rle_uncompressed' form."""
+        if annotation_format == "polygon":
+            return self.get_polygon_annotations(image_id, simplify_tolerance)
+        if annotation_format in ("rle", "rle_uncompressed"):
+            return self.get_rle_annotations(image_id, compressed=annotation_format == "rle")
+        raise ValueError(f"Invalid annotation_format: {annotation_format}")
     
     def plot_results(self):
+        import matplotlib.pyplot as plt
+
         num_subplots = self.num_clusters + 2  # Original + segmented + each cluster
         plt.figure(figsize=(15, 5))
         
@@ -150,59 +241,373 @@ class ImageSegmenter:
         return {"image_path": self.image_path, "width": self.img_rgb.shape[1], "height": self.img_rgb.shape[0]}
 
 
-def process_folder(folder_path: str, output_json: str):
+def _limit_worker_threads(threads_per_worker: int):
+    """Pool initializer: caps BLAS/OpenMP and OpenCV threads inside each worker."""
+    from threadpoolctl import threadpool_limits
+
+    threadpool_limits(limits=threads_per_worker)
+    cv2.setNumThreads(threads_per_worker)
+
+
+def annotate_image(img_file: str, image_id: int, annotation_format: str = "polygon",
+                   simplify_tolerance: float = 0.0):
+    """Segments one image and returns its COCO image entry and annotations (without ids)."""
+    print(f"Processing image: {img_file}")
+    segmenter = ImageSegmenter(image_path=img_file, num_clusters=2)
+    img_info = segmenter.run()  # Run segmentation pipeline
+    image_entry = {
+        "id": image_id,
+        "width": img_info["width"],
+        "height": img_info["height"],
+        "file_name": os.path.basename(img_file)
+    }
+    annotations = segmenter.get_annotations(image_id, annotation_format, simplify_tolerance)
+    return image_entry, annotations
+
+
+COCO_INFO = {
+    "description": "COCO-format semantic segmentation dataset (polygon annotations) from folder processing",
+    "version": "1.0",
+    "year": 2025,
+    "contributor": "Gosh",
+    "date_created": "2025-03-02"
+}
+COCO_CATEGORIES = [
+    {"id": 1, "name": "background", "supercategory": "none"},
+    {"id": 2, "name": "material", "supercategory": "none"}
+]
+
+
+class CocoStreamWriter:
+    """
+    Writes a COCO JSON file incrementally.
+
+    Every finished image is appended, with its annotations, to two JSON-lines
+    part files next to the output (`<output>.images.part` and
+    `<output>.annotations.part`) and flushed, so memory stays flat and a crash
+    loses at most the image in flight. close() streams the parts into the final
+    COCO document and removes them, unless `keep_parts=True` keeps them for a
+    later incremental run. With `resume=True` the parts of an interrupted run
+    are kept and writing continues after them.
+    """
+
+    def __init__(self, output_json: str, indent: int = None, resume: bool = False,
+                 info: dict = None, categories: list = None, keep_parts: bool = False):
+        self.output_json = output_json
+        self.indent = indent
+        self.keep_parts = keep_parts
+        self.info = info or COCO_INFO
+        self.categories = categories or COCO_CATEGORIES
+        self.images_part = output_json + ".images.part"
+        self.annotations_part = output_json + ".annotations.part"
+
+        self.processed_files = set()
+        self.next_image_id = 1
+        self.next_ann_id = 1
+
+        if resume:
+            self._recover()
+        mode = "a" if resume else "w"
+        self._images = open(self.images_part, mode)
+        self._annotations = open(self.annotations_part, mode)
+
+    @staticmethod
+    def _read_lines(path: str):
+        """Yields the parsed entries of a part file, skipping a truncated last line."""
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+    def _recover(self):
+        """Loads the state of an interrupted run and drops annotations of unfinished images."""
+        image_ids = set()
+        valid_lines = []
+        for entry in self._read_lines(self.images_part):
+            image_ids.add(entry["id"])
+            self.processed_files.add(entry["file_name"])
+            self.next_image_id = max(self.next_image_id, entry["id"] + 1)
+            valid_lines.append(json.dumps(entry) + "\n")
+        with open(self.images_part, "w") as f:
+            f.writelines(valid_lines)
+
+        # Rewrite the annotation part, streaming, without orphaned entries
+        tmp_path = self.annotations_part + ".tmp"
+        with open(tmp_path, "w") as out:
+            for ann in self._read_lines(self.annotations_part):
+                if ann["image_id"] in image_ids:
+                    out.write(json.dumps(ann) + "\n")
+                    self.next_ann_id = max(self.next_ann_id, ann["id"] + 1)
+        os.replace(tmp_path, self.annotations_part)
+        print(f"Resuming after {len(self.processed_files)} processed images.")
+
+    def add_image(self, image_entry: dict, annotations: list):
+        """Appends one image and its annotations, which get sequential ids."""
+        for ann in annotations:
+            ann["id"] = self.next_ann_id
+            self.next_ann_id += 1
+            self._annotations.write(json.dumps(ann) + "\n")
+        self._annotations.flush()
+
+        # The image line is written last: its presence marks the image as complete
+        self._images.write(json.dumps(image_entry) + "\n")
+        self._images.flush()
+
+        self.processed_files.add(image_entry["file_name"])
+        self.next_image_id = max(self.next_image_id, image_entry["id"] + 1)
+
+    def carry_over(self, images_part: str, annotations_part: str, drop_image_ids: set):
+        """
+        Streams the entries of kept part files of an earlier run, with their ids,
+        except those of the images in `drop_image_ids`.
+        """
+        for ann in self._read_lines(annotations_part):
+            if ann["image_id"] not in drop_image_ids:
+                self._annotations.write(json.dumps(ann) + "\n")
+                self.next_ann_id = max(self.next_ann_id, ann["id"] + 1)
+        self._annotations.flush()
+
+        for entry in self._read_lines(images_part):
+            if entry["id"] not in drop_image_ids:
+                self._images.write(json.dumps(entry) + "\n")
+                self.processed_files.add(entry["file_name"])
+                self.next_image_id = max(self.next_image_id, entry["id"] + 1)
+        self._images.flush()
+
+    def _dump(self, value, level: int) -> str:
+        if self.indent is None:
+            return json.dumps(value, separators=(",", ":"))
+        text = json.dumps(value, indent=self.indent)
+        return text.replace("\n", "\n" + " " * (self.indent * level))
+
+    def _write_array(self, out, path: str):
+        pad = "" if self.indent is None else "\n" + " " * (self.indent * 2)
+        separator = "," + pad
+        out.write("[" + pad)
+        for i, entry in enumerate(self._read_lines(path)):
+            if i:
+                out.write(separator)
+            out.write(self._dump(entry, 2))
+        out.write("" if self.indent is None else "\n" + " " * self.indent)
+        out.write("]")
+
+    def close(self):
+        """Assembles the final COCO JSON from the part files and removes them."""
+        self._images.close()
+        self._annotations.close()
+
+        pad = "" if self.indent is None else "\n" + " " * self.indent
+        colon = ":" if self.indent is None else ": "
+        tmp_path = self.output_json + ".tmp"
+        with open(tmp_path, "w") as out:
+            out.write("{" + pad)
+            out.write(f'"info"{colon}{self._dump(self.info, 1)},{pad}')
+            out.write(f'"licenses"{colon}[],{pad}')
+            out.write(f'"images"{colon}')
+            self._write_array(out, self.images_part)
+            out.write(f",{pad}" + f'"annotations"{colon}')
+            self._write_array(out, self.annotations_part)
+            out.write(f",{pad}" + f'"categories"{colon}{self._dump(self.categories, 1)}')
+            out.write("" if self.indent is None else "\n")
+            out.write("}")
+        os.replace(tmp_path, self.output_json)
 
+        if not self.keep_parts:
+            os.remove(self.images_part)
+            os.remove(self.annotations_part)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Keep the part files so the run can be resumed
+            self._images.close()
+            self._annotations.close()
+
+
+def _annotate_all(image_files, image_ids, workers, threads_per_worker, annotate):
+    """Yields (image_entry, annotations) in input order, fanned out over a process pool."""
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        yield from map(annotate, image_files, image_ids)
+        return
+
+    pool = ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_limit_worker_threads,
+        initargs=(threads_per_worker,),
+    )
+    try:
+        yield from pool.map(annotate, image_files, image_ids)
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def _list_images(folder_path: str):
     image_files = glob.glob(os.path.join(folder_path, "*.*"))
-    image_files = [f for f in image_files if f.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp'))]
+    image_files = sorted(f for f in image_files if f.lower().endswith(IMAGE_EXTENSIONS))
     print(f"Found {len(image_files)} images in folder {folder_path}.")
-    
-    coco = {
-        "info": {
-            "description": "COCO-format semantic segmentation dataset (polygon annotations) from folder processing",
-            "version": "1.0",
-            "year": 2025,
-            "contributor": "Gosh",
-            "date_created": "2025-03-02"
-        },
-        "licenses": [],
-        "images": [],
-        "annotations": [],
-        "categories": [
-            {"id": 1, "name": "background", "supercategory": "none"},
-            {"id": 2, "name": "material", "supercategory": "none"}
-        ]
-    }
-    
-    image_id = 1
-    ann_id = 1
-    
+    return image_files
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def process_folder(folder_path: str, output_json: str, workers: int = None, threads_per_worker: int = 1,
+                   indent: int = 4, resume: bool = False, annotation_format: str = "polygon",
+                   simplify_tolerance: float = 0.0, incremental: bool = False):
+    """
+    Annotates every image in `folder_path` and streams one COCO JSON file.
+
+    Images are fanned out over `workers` processes (CPU count by default, 1 runs
+    in-process). Files are sorted by name and results are collected in that
+    order, so image and annotation ids do not depend on scheduling. Entries are
+    written as each image finishes; `indent=None` produces compact JSON and
+    `resume=True` continues an interrupted run instead of starting over.
+    `annotation_format` selects polygons, compressed RLE ('rle') or
+    'rle_uncompressed'; `simplify_tolerance` simplifies polygons.
+    `incremental=True` only annotates new or changed images (see process_folder_incremental).
+    """
+    if incremental:
+        if resume:
+            raise ValueError("incremental and resume cannot be combined")
+        process_folder_incremental(folder_path, output_json, workers, threads_per_worker, indent,
+                                   annotation_format, simplify_tolerance)
+        return
+
+    annotate = partial(annotate_image, annotation_format=annotation_format,
+                       simplify_tolerance=simplify_tolerance)
+
+    image_files = _list_images(folder_path)
+
+    with CocoStreamWriter(output_json, indent=indent, resume=resume) as writer:
+        pending = [f for f in image_files if os.path.basename(f) not in writer.processed_files]
+        image_ids = range(writer.next_image_id, writer.next_image_id + len(pending))
+        results = _annotate_all(pending, image_ids, workers, threads_per_worker, annotate)
+
+        for img_file, (image_entry, ann_list) in zip(pending, results):
+            writer.add_image(image_entry, ann_list)
+            print("Image {} is processed".format(img_file))
+
+    print(f"COCO annotation for folder saved to {output_json}")
+
+
+def process_folder_incremental(folder_path: str, output_json: str, workers: int = None,
+                               threads_per_worker: int = 1, indent: int = 4,
+                               annotation_format: str = "polygon", simplify_tolerance: float = 0.0):
+    """
+    Updates an existing COCO output with only the new or changed images of the folder.
+
+    A manifest next to the output (`<output>.manifest.json`) records the
+    annotation settings and the content hash, mtime, size and image id of
+    every annotated file. Files whose mtime and size are unchanged are skipped
+    without hashing; otherwise the hash decides. Changed images keep their
+    image id, new images get fresh ids, and entries of untouched images keep
+    their ids. Images removed from the folder are dropped. Annotation ids are
+    never reused. A run with other annotation settings re-annotates every image.
+
+    The per-image JSON-lines parts of the output are kept next to the manifest,
+    so unchanged entries are streamed over from them instead of loading the
+    previous COCO document.
+    """
+    manifest_path = output_json + ".manifest.json"
+    settings = {"annotation_format": annotation_format, "simplify_tolerance": simplify_tolerance}
+    annotate = partial(annotate_image, **settings)
+
+    # Parts of the previous run; they are moved aside while the new parts are
+    # written, and an interrupted run leaves them there for the next attempt
+    images_part, annotations_part = output_json + ".images.part", output_json + ".annotations.part"
+    previous_images, previous_annotations = images_part + ".prev", annotations_part + ".prev"
+    if not (os.path.exists(previous_images) and os.path.exists(previous_annotations)):
+        previous_images, previous_annotations = images_part, annotations_part
+
+    manifest = {"files": {}, "next_image_id": 1, "next_ann_id": 1}
+    if all(os.path.exists(path) for path in (manifest_path, output_json, previous_images, previous_annotations)):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    known = manifest["files"]
+    settings_changed = bool(known) and any(manifest.get(key) != value for key, value in settings.items())
+    if settings_changed:
+        print("Annotation settings changed: every image is annotated again.")
+
+    image_files = _list_images(folder_path)
+    current = {}
+    pending, pending_ids = [], []
+    next_image_id = manifest["next_image_id"]
+
     for img_file in image_files:
-        print(f"Processing image: {img_file}")
-        segmenter = ImageSegmenter(image_path=img_file, num_clusters=2)
-        img_info = segmenter.run()  # Run segmentation pipeline
-        width = img_info["width"]
-        height = img_info["height"]
         file_name = os.path.basename(img_file)
-        
-        coco["images"].append({
-            "id": image_id,
-            "width": width,
-            "height": height,
-            "file_name": file_name
-        })
-        
-        ann_list = segmenter.get_polygon_annotations(image_id)
-        for ann in ann_list:
-            # Assign a unique annotation id
-            ann["id"] = ann_id
-            coco["annotations"].append(ann)
-            ann_id += 1
-        
-        image_id += 1
-        print("Image {} is processed".format(img_file))
-    
-    with open(output_json, 'w') as f:
-        json.dump(coco, f, indent=4)
+        stat = os.stat(img_file)
+        record = known.get(file_name)
+
+        if not settings_changed and record and \
+                record["mtime_ns"] == stat.st_mtime_ns and record["size"] == stat.st_size:
+            current[file_name] = record
+            continue
+
+        sha256 = file_sha256(img_file)
+        if not settings_changed and record and record["sha256"] == sha256:
+            current[file_name] = dict(record, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+            continue
+
+        if record:
+            image_id = record["image_id"]
+        else:
+            image_id = next_image_id
+            next_image_id += 1
+        current[file_name] = {"sha256": sha256, "mtime_ns": stat.st_mtime_ns,
+                              "size": stat.st_size, "image_id": image_id}
+        pending.append(img_file)
+        pending_ids.append(image_id)
+
+    removed = set(known) - set(current)
+    print(f"{len(pending)} new or changed images, {len(removed)} removed, "
+          f"{len(current) - len(pending)} unchanged.")
+    if not pending and not removed:
+        return
+
+    stale_ids = {known[name]["image_id"] for name in removed}
+    stale_ids.update(pending_ids)
+    if known and previous_images == images_part:
+        previous_images, previous_annotations = images_part + ".prev", annotations_part + ".prev"
+        os.replace(images_part, previous_images)
+        os.replace(annotations_part, previous_annotations)
+
+    with CocoStreamWriter(output_json, indent=indent, keep_parts=True) as writer:
+        if known:
+            writer.carry_over(previous_images, previous_annotations, stale_ids)
+        writer.next_ann_id = max(writer.next_ann_id, manifest["next_ann_id"])
+        results = _annotate_all(pending, pending_ids, workers, threads_per_worker, annotate)
+        for img_file, (image_entry, ann_list) in zip(pending, results):
+            writer.add_image(image_entry, ann_list)
+            print("Image {} is processed".format(img_file))
+
+    manifest = dict(
+        settings,
+        files=current,
+        next_image_id=max(next_image_id, writer.next_image_id),
+        next_ann_id=writer.next_ann_id,
+    )
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+    for path in (images_part + ".prev", annotations_part + ".prev"):
+        if os.path.exists(path):
+            os.remove(path)
     print(f"COCO annotation for folder saved to {output_json}")
 
 
@@ -1,13 +1,44 @@
 import os
 import cv2
+import csv
+import glob
+import json
 import argparse
 import numpy as np
-import matplotlib.pyplot as plt
+from dataclasses import dataclass
 from sklearn.cluster import KMeans
 
 
+# Values of the label map returned by a headless run
+LABEL_BACKGROUND = 0  # First-pass background
+LABEL_MATERIAL = 1    # First-pass material in the brighter second-pass cluster
+LABEL_REJECTED = 2    # First-pass material in the darker second-pass cluster
+
+
+@dataclass
+class SegmentationResult:
+    """Arrays produced by a headless segmentation run."""
+    label_map: np.ndarray       # (H, W) uint8 with LABEL_* values
+    overlay_mask: np.ndarray    # (H, W) bool, pixels kept in the overlay image
+    overlay_percentage: float   # Share of overlay pixels in the whole image
+    material_percentage: float  # Share of first-pass material in the whole image
+    first_centers: np.ndarray   # (2, 1) grayscale centers of the first pass
+    second_centers: np.ndarray  # (2, 3) RGB centers of the second pass
+
+    @property
+    def material_mask(self):
+        """(H, W) bool mask of the first-pass material, as in the app's masks."""
+        return self.label_map != LABEL_BACKGROUND
+
+    def overlay(self, img_rgb):
+        """Returns the overlay image: the original with every other pixel blacked out."""
+        combined = np.zeros_like(img_rgb)
+        combined[self.overlay_mask] = img_rgb[self.overlay_mask]
+        return combined
+
+
 class Segmenter:
-    def __init__(self, image_path, material_selection='auto'):
+    def __init__(self, image_path, material_selection='auto', headless=False, save_dir=None):
         """
         Args:
             image_path: Path to the image file
@@ -15,12 +46,21 @@ class Segmenter:
                 - 'auto': Use the smaller cluster (assumes material < 50% of image)
                 - 'bright': Use the brighter cluster
                 - 'dark': Use the darker cluster
+            headless: If True, __call__ returns a SegmentationResult and never
+                      imports matplotlib
+            save_dir: In headless mode, directory for the mask and overlay PNGs
+                      (nothing is written when None)
         """
         self.image_path = image_path
         self.material_selection = material_selection
+        self.headless = headless
+        self.save_dir = save_dir
 
-        self.img_rgb = cv2.cvtColor(cv2.imread(self.image_path), cv2.COLOR_BGR2RGB)
-        self.img_gray = cv2.imread(self.image_path, cv2.IMREAD_GRAYSCALE)
+        img_bgr = cv2.imread(self.image_path)
+        if img_bgr is None:
+            raise ValueError(f"Image not found: {self.image_path}")
+        self.img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
+        self.img_gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
 
         self.first_kmeans = KMeans(n_clusters=2, n_init=10, random_state=42)
         self.second_kmeans = KMeans(n_clusters=2, n_init=10, random_state=42)
@@ -40,6 +80,20 @@ class Segmenter:
         cluster_centers = self.first_kmeans.cluster_centers_
         return labels_2d, cluster_centers
 
+    def _select_material_cluster(self, label2d, cluster_centers):
+        """Picks the first-pass cluster that represents the material."""
+        if self.material_selection == 'auto':
+            # Use the smaller cluster (assumes material is minority)
+            cluster_0_count, cluster_1_count = np.bincount(label2d.ravel(), minlength=2)[:2]
+            return 0 if cluster_0_count < cluster_1_count else 1
+        elif self.material_selection == 'bright':
+            # Use the brighter cluster
+            return int(np.argmax(cluster_centers.flatten()))
+        elif self.material_selection == 'dark':
+            # Use the darker cluster
+            return int(np.argmin(cluster_centers.flatten()))
+        raise ValueError(f"Invalid material_selection: {self.material_selection}")
+
     def _plot_first_pass(
         self,
         segmented_image_material,
@@ -48,6 +102,8 @@ class Segmenter:
         background_percentage,
     ):
         """Plots results of the first segmentation."""
+        import matplotlib.pyplot as plt
+
         plt.figure(figsize=(12, 6))
 
         plt.subplot(1, 3, 1)
@@ -72,59 +128,60 @@ class Segmenter:
         plt.tight_layout()
         plt.show()
 
-    def _second_segmentation(self, segmented_image_material):
-
-        flat_img = segmented_image_material.reshape((-1, 3))
-        non_black_mask = np.any(flat_img != [0, 0, 0], axis=1)
-
-        material_only_pixels = flat_img[non_black_mask]
+    def _second_segmentation(self, material_mask):
+        """
+        Runs the second K-Means on the RGB values selected by the boolean
+        `material_mask`. Returns the 2D label array (0 outside the mask).
+        """
+        material_only_pixels = self.img_rgb[material_mask]
 
         self.second_kmeans.fit(material_only_pixels)
         second_labels = self.second_kmeans.labels_
 
-        new_labels_full = np.zeros((len(flat_img),), dtype=np.int32)
-        new_labels_full[non_black_mask] = second_labels
-
-        new_labels_2d = new_labels_full.reshape(segmented_image_material.shape[:2])
+        new_labels_2d = np.zeros(material_mask.shape, dtype=np.int32)
+        new_labels_2d[material_mask] = second_labels
         return new_labels_2d
 
+    def _output_path(self, save_dir, suffix):
+        os.makedirs(save_dir, exist_ok=True)
+        stem = os.path.splitext(os.path.basename(self.image_path))[0]
+        return os.path.join(save_dir, f"{stem}{suffix}")
+
     def _save_image_(self, combined_background, material_percentage):
+        import matplotlib.pyplot as plt
+
         plt.imshow(combined_background)
         plt.title(f"Overlay: Material Al {material_percentage:.2f}%")
         plt.axis("off")
         plt.tight_layout()
 
-        save_dir = "Predictions"
-        if not os.path.exists(save_dir):
-            os.makedirs(save_dir, exist_ok=True)
-
-        filename = os.path.basename(self.image_path)[:-4] + "_percentage.png"
-        save_path = os.path.join(save_dir, filename)
+        save_path = self._output_path("Predictions", "_percentage.png")
 
         plt.savefig(save_path)
         print(f"Saved in {save_path}")
 
         plt.close()
 
+    def write_outputs(self, result, save_dir):
+        """
+        Writes the binary material mask and the overlay image of a headless run
+        with cv2.imencode. Returns the (mask_path, overlay_path) pair.
+        """
+        mask_path = self._output_path(save_dir, "_mask.png")
+        overlay_path = self._output_path(save_dir, "_overlay.png")
 
-    def _plot_second_pass(
-        self,
-        segmented_image_background_first,
-        segmented_image_background_second,
-    ):
-        def overlay_images(pass1_image, pass2_image):
-            combined = pass1_image.copy()
-            mask = np.any(pass2_image != [0, 0, 0], axis=-1)
-            combined[mask] = pass2_image[mask]
-            return combined
-
-        combined_background = overlay_images(
-            segmented_image_background_first, segmented_image_background_second
-        )
-        total_pixels = self.img_gray.size
-        mask_non_black = np.any(combined_background != [0, 0, 0], axis=-1)
-        material_pixels = np.count_nonzero(mask_non_black)
-        material_percentage = (material_pixels / total_pixels) * 100
+        ok_mask, mask_png = cv2.imencode(".png", result.material_mask.astype(np.uint8) * 255)
+        overlay_bgr = cv2.cvtColor(result.overlay(self.img_rgb), cv2.COLOR_RGB2BGR)
+        ok_overlay, overlay_png = cv2.imencode(".png", overlay_bgr)
+        if not (ok_mask and ok_overlay):
+            raise IOError(f"Could not encode outputs for {self.image_path}")
+
+        mask_png.tofile(mask_path)
+        overlay_png.tofile(overlay_path)
+        return mask_path, overlay_path
+
+    def _plot_second_pass(self, combined_background, material_percentage):
+        import matplotlib.pyplot as plt
 
         plt.figure(figsize=(16, 10))
 
@@ -143,65 +200,188 @@ class Segmenter:
         self._save_image_(combined_background=combined_background, 
                           material_percentage=material_percentage)
 
-    def __call__(self):
+    def segment(self):
+        """Runs both segmentation passes without rendering anything."""
         pixels = self._load_image()
         label2d, cluster_centers = self._kmeans_first_pass(pixels)
+        material_cluster = self._select_material_cluster(label2d, cluster_centers)
 
-        # Select which cluster represents the material
-        if self.material_selection == 'auto':
-            # Use the smaller cluster (assumes material is minority)
-            cluster_0_count = np.sum(label2d == 0)
-            cluster_1_count = np.sum(label2d == 1)
-            material_cluster = 0 if cluster_0_count < cluster_1_count else 1
-        elif self.material_selection == 'bright':
-            # Use the brighter cluster
-            avg_intensity = cluster_centers.flatten()
-            material_cluster = np.argmax(avg_intensity)
-        elif self.material_selection == 'dark':
-            # Use the darker cluster
-            avg_intensity = cluster_centers.flatten()
-            material_cluster = np.argmin(avg_intensity)
-        else:
-            raise ValueError(f"Invalid material_selection: {self.material_selection}")
-
-        binary_mask = (label2d == material_cluster).astype(np.uint8)
+        # Black pixels never take part in the second pass or the overlay
+        non_black = np.any(self.img_rgb != 0, axis=-1)
+        binary_mask = label2d == material_cluster
+        del label2d
 
-        segmented_image_material_first = self.img_rgb.copy()
-        segmented_image_background_first = self.img_rgb.copy()
-
-        # binary_mask == 1 means material (brighter cluster)
-        # binary_mask == 0 means background (darker cluster)
-        segmented_image_material_first[binary_mask == 0] = [0, 0, 0]  # Remove background pixels
-        segmented_image_background_first[binary_mask == 1] = [0, 0, 0]  # Remove material pixels
-
-        new_labels_2d = self._second_segmentation(segmented_image_material_first)
+        new_labels_2d = self._second_segmentation(binary_mask & non_black)
 
         second_centers = self.second_kmeans.cluster_centers_
 
         avg_color_intensity = np.sum(second_centers, axis=1)
         material_cluster_2 = np.argmax(avg_color_intensity)
 
-        segmented_image_material_second = segmented_image_material_first.copy()
-        segmented_image_background_second = segmented_image_material_first.copy()
-
-        material_mask_2 = new_labels_2d == material_cluster_2
-        segmented_image_material_second[~material_mask_2] = [0, 0, 0]
+        label_map = np.full(binary_mask.shape, LABEL_BACKGROUND, dtype=np.uint8)
+        label_map[binary_mask] = LABEL_REJECTED
+        label_map[binary_mask & (new_labels_2d == material_cluster_2)] = LABEL_MATERIAL
+        del new_labels_2d
+
+        # Overlay: first-pass background plus the material the second pass did not
+        # keep as the brighter cluster
+        overlay_mask = (label_map != LABEL_MATERIAL) & non_black
+        overlay_percentage = np.count_nonzero(overlay_mask) / self.img_gray.size * 100
+        material_percentage = np.count_nonzero(binary_mask) / self.img_gray.size * 100
+
+        return SegmentationResult(
+            label_map=label_map,
+            overlay_mask=overlay_mask,
+            overlay_percentage=float(overlay_percentage),
+            material_percentage=float(material_percentage),
+            first_centers=cluster_centers,
+            second_centers=second_centers,
+        )
 
-        segmented_image_background_second[material_mask_2] = [0, 0, 0]
+    def __call__(self):
+        result = self.segment()
+
+        if self.headless:
+            if self.save_dir:
+                self.write_outputs(result, self.save_dir)
+            return result
+
+        combined_background = result.overlay(self.img_rgb)
+        self._plot_second_pass(combined_background, result.overlay_percentage)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS",
+)
+
+
+def collect_images(input_path):
+    """Resolves a directory or glob pattern to a sorted list of image files."""
+    if os.path.isdir(input_path):
+        candidates = glob.glob(os.path.join(input_path, "*.*"))
+    else:
+        candidates = glob.glob(input_path, recursive=True)
+    return sorted(f for f in candidates if f.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def _limit_worker_threads(threads_per_worker):
+    """Pool initializer: caps BLAS/OpenMP and OpenCV threads inside each worker."""
+    from threadpoolctl import threadpool_limits
+
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads_per_worker)
+    threadpool_limits(limits=threads_per_worker)
+    cv2.setNumThreads(threads_per_worker)
+
+
+def _segment_file(image_path, output_dir, material_selection):
+    """Segments one image headlessly and writes its binary material mask."""
+    record = {"image": image_path, "mask": None, "material_percentage": None, "error": None}
+    try:
+        segmenter = Segmenter(image_path=image_path, material_selection=material_selection, headless=True)
+        result = segmenter()
+        mask_path, _ = segmenter.write_outputs(result, output_dir)
+
+        record["mask"] = mask_path
+        record["material_percentage"] = round(result.material_percentage, 4)
+    except Exception as e:
+        record["error"] = str(e)
+    return record
+
+
+def write_summary(records, summary_path):
+    """Writes the per-image results as CSV or JSON depending on the file extension."""
+    if summary_path.lower().endswith(".json"):
+        with open(summary_path, "w") as f:
+            json.dump(records, f, indent=2)
+        return
+
+    with open(summary_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["image", "mask", "material_percentage", "error"])
+        writer.writeheader()
+        writer.writerows(records)
+
+
+def run_batch(input_path, output_dir, summary_path=None, workers=None,
+              threads_per_worker=1, material_selection='auto'):
+    """
+    Segments every image matched by `input_path` across a process pool.
+
+    Args:
+        input_path: Directory or glob pattern of input images
+        output_dir: Directory receiving the `<name>_mask.png` files
+        summary_path: CSV or JSON file with per-image material percentages
+                      (defaults to `<output_dir>/summary.csv`)
+        workers: Number of worker processes (defaults to CPU count / threads_per_worker)
+        threads_per_worker: BLAS/OpenMP/OpenCV threads allowed in each worker
+        material_selection: 'auto', 'bright' or 'dark'
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    image_files = collect_images(input_path)
+    if not image_files:
+        raise ValueError(f"No images found for {input_path}")
+
+    os.makedirs(output_dir, exist_ok=True)
+    summary_path = summary_path or os.path.join(output_dir, "summary.csv")
+    workers = workers or max(1, (os.cpu_count() or 1) // threads_per_worker)
+
+    # Children inherit the limits at import time; the initializer enforces them afterwards too
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads_per_worker)
+
+    print(f"Processing {len(image_files)} images with {workers} workers "
+          f"({threads_per_worker} thread(s) each)")
+
+    records = []
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_limit_worker_threads,
+        initargs=(threads_per_worker,),
+    ) as pool:
+        futures = [
+            pool.submit(_segment_file, image_path, output_dir, material_selection)
+            for image_path in image_files
+        ]
+        for done, future in enumerate(as_completed(futures), start=1):
+            record = future.result()
+            records.append(record)
+            status = record["error"] or f"{record['material_percentage']:.2f}%"
+            print(f"[{done}/{len(image_files)}] {record['image']}: {status}")
+
+    records.sort(key=lambda r: r["image"])
+    write_summary(records, summary_path)
+    print(f"Summary saved in {summary_path}")
+    return records
 
-        self._plot_second_pass(
-            segmented_image_background_first=segmented_image_background_first,
-            segmented_image_background_second=segmented_image_background_second,
-        )
 
 def main():
     parser = argparse.ArgumentParser(description="Segment an image using the Segmenter class.")
-    parser.add_argument("--image_path", type=str, required=True, help="Path to the input image.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--image_path", type=str, help="Path to the input image.")
+    source.add_argument("--input", type=str, help="Directory or glob of images for headless batch processing.")
+    parser.add_argument("--output_dir", type=str, default="Predictions", help="Where batch masks are written.")
+    parser.add_argument("--summary", type=str, default=None, help="Batch summary file (.csv or .json).")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes.")
+    parser.add_argument("--threads_per_worker", type=int, default=1, help="BLAS/OpenMP threads per worker.")
+    parser.add_argument("--material_selection", type=str, default="auto", choices=["auto", "bright", "dark"])
 
     args = parser.parse_args()
 
-    vle = Segmenter(image_path=args.image_path)
+    if args.input:
+        run_batch(
+            input_path=args.input,
+            output_dir=args.output_dir,
+            summary_path=args.summary,
+            workers=args.workers,
+            threads_per_worker=args.threads_per_worker,
+            material_selection=args.material_selection,
+        )
+        return
+
+    vle = Segmenter(image_path=args.image_path, material_selection=args.material_selection)
     vle()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
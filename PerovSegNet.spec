@@ -38,6 +38,16 @@ hiddenimports = [
     'app.processing.security',
     'app.processing.image_processor',
     'app.processing.model',
+    'app.processing.clustering',
+    'app.processing.image_io',
+    'app.processing.cache',
+    'app.processing.profiling',
+    'app.processing.session',
+    'app.processing.sequence',
+    'app.processing.store',
+    'app.processing.batch',
+    'app.processing.labels',
+    'app.processing.persistence',
     'app.ui',
     'app.ui.components',
     # Streamlit dependencies
@@ -54,7 +64,9 @@ a = Analysis(
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
-    excludes=[],
+    # Plotting is only used by the standalone scripts; leaving it out shrinks the
+    # one-file archive that is unpacked on every launch
+    excludes=['matplotlib'],
     win_no_prefer_redirects=False,
     win_private_assemblies=False,
     cipher=block_cipher,
@@ -3,11 +3,36 @@ from typing import Dict, Any
 class AppConfig:
     DEFAULTS: Dict[str, Any] = {
         'SAVE_DIR': 'predictions',
+        'RESULT_STORE_DIR': 'predictions/store',  # SQLite index + label maps; None disables
         'MAX_FILE_SIZE': 10_000_000,  # 10MB
         'ALLOWED_MIME_TYPES': ['image/png', 'image/jpeg','image/jpg'],
         'CACHE_TIMEOUT': 3600,
+        'RESULT_CACHE_BYTES': 256 * 1024 * 1024,  # 256MB of cached label maps
         'NUM_CLUSTERS': 3,
-        'LOGS_DIR': './app/logs'
+        'FIT_SAMPLE_SIZE': None,  # Pixels used to fit each pass; None fits on every pixel
+        'FIT_SAMPLE_SEED': 42,
+        'KMEANS_INIT': 'seeded',  # 'seeded' = one deterministic run; 'k-means++' = random restarts
+        'KMEANS_THREADS': None,  # Thread budget of concurrent restarts; None = every core
+        'WARM_START_SESSIONS': False,  # Seed each upload's clustering from the previous upload
+        'WARM_START_MAX_DRIFT': 12.0,  # Center drift (0-255 units) that forces a cold fit
+        'WARM_START_MAX_INERTIA_RATIO': 1.5,  # Inertia growth that forces a cold fit
+        'LOGS_DIR': './app/logs',
+        'PROFILE_MEMORY': False,  # Track allocated bytes per stage with tracemalloc (slows allocations down)
+        'SHOW_STAGE_PROFILE': False,  # Show per-stage timings in the Streamlit UI
+        'PREWARM_ENGINE': True,  # Load the segmentation engine in the background after the first render
+        'OUTPUT_FORMAT': 'png',  # Saved/downloaded result: 'png' or 'webp' (lossless) overlay, 'mask' (1-bit PNG)
+        'OUTPUT_PNG_COMPRESSION': None,  # zlib level 0-9 of overlay PNGs; None = OpenCV's speed-tuned default
+        'PERSIST_QUEUE_SIZE': 4,  # Encoded results waiting to be written in the background; 0 saves synchronously
+        'PROGRESSIVE_PREVIEW': True,  # Show a low-resolution result while large images are refined
+        'PREVIEW_MIN_PIXELS': 4_000_000,  # Smaller images are analyzed at full resolution directly
+        'PREVIEW_MAX_SIDE': 512,
+        'BATCH_WORKERS': 4,  # Images of a multi-file upload processed at once; None = one per CPU
+        'API_HOST': '0.0.0.0',
+        'API_PORT': 8000,
+        'API_WORKERS': None,  # None = one worker process per CPU
+        'API_THREADS_PER_WORKER': 1,
+        'API_MAX_PENDING': 64,  # Images queued on the worker pool at once
+        'API_MAX_BATCH': 100
     }
     
     @classmethod
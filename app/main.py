@@ -1,19 +1,20 @@
 import os
-import cv2
+import time
 import logging
+import threading
 from logging.handlers import RotatingFileHandler
-import tempfile
 import streamlit as st
 
-from datetime import datetime
 from config import AppConfig
 from processing.security import validate_upload, save_segmented_image
-from processing.image_processor import ImageProcessor
 from ui.components import (
     apply_custom_css,
     render_header,
     file_uploader,
     display_results,
+    display_stage_profile,
+    display_batch_status,
+    create_batch_downloads,
     create_download_button
 )
 
@@ -35,6 +36,113 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+# The segmentation stack (sklearn, scipy, cv2) is imported on first use or by the
+# background warm-up, so the first page renders without waiting for it.
+
+
+@st.cache_resource(show_spinner=False)
+def prewarm_engine():
+    """Imports and exercises the segmentation engine once per server process, in the background."""
+    def warm():
+        start = time.perf_counter()
+        from processing.image_processor import warm_up
+        warm_up()
+        logger.info(f"Segmentation engine warmed up in {time.perf_counter() - start:.2f}s")
+
+    thread = threading.Thread(target=warm, name="engine-prewarm", daemon=True)
+    thread.start()
+    return thread
+
+
+def log_startup_time():
+    """In launcher timing mode, logs the time from launch to the first rendered page."""
+    launched = os.environ.pop('PEROVSEGNET_LAUNCH_TIME', None)
+    if launched:
+        logger.info(f"Startup timing: first page rendered {time.time() - float(launched):.2f}s after launch")
+
+
+def clustering_session():
+    """Per-browser-session clustering model, or None when warm starts are disabled."""
+    if not AppConfig.get('WARM_START_SESSIONS'):
+        return None
+    if 'clustering_session' not in st.session_state:
+        from processing.session import ClusteringSession
+
+        st.session_state['clustering_session'] = ClusteringSession(
+            max_drift=AppConfig.get('WARM_START_MAX_DRIFT'),
+            max_inertia_ratio=AppConfig.get('WARM_START_MAX_INERTIA_RATIO'),
+        )
+    return st.session_state['clustering_session']
+
+
+@st.cache_resource(show_spinner=False)
+def background_executor():
+    """
+    Background pool shared by every browser session for batch images and
+    full-resolution refinements, so concurrent work queues on it.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from processing.batch import batch_threads
+
+    workers, _ = batch_threads()
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="analysis")
+
+
+def encoded_output(processor, result):
+    """
+    The result encoded once in the configured output format; saving and the
+    download button share the bytes, and reruns of the same result reuse them.
+    """
+    from processing.persistence import encode_output
+
+    key = (processor.cache_key, AppConfig.get('OUTPUT_FORMAT'), AppConfig.get('OUTPUT_PNG_COMPRESSION'))
+    cached = st.session_state.get('encoded_output')
+    if cached is None or cached[0] != key:
+        cached = (key, encode_output(result, processor.labels))
+        st.session_state['encoded_output'] = cached
+    return cached[1]
+
+
+def wants_preview(processor) -> bool:
+    """Large images without a stored result get a progressive preview."""
+    height, width = processor.original_image.shape[:2]
+    return (
+        AppConfig.get('PROGRESSIVE_PREVIEW')
+        and height * width >= AppConfig.get('PREVIEW_MIN_PIXELS')
+        and not processor.has_result()
+    )
+
+
+def analyze_progressively(processor):
+    """
+    Shows the result of a low-resolution pyramid level right away, then refines
+    at full resolution in the background and clears the preview once the full
+    result is ready. Changing the mode while the preview is shown reruns the
+    page immediately; the refinement still completes and is cached, and it may
+    share the browser session's ClusteringSession with the next upload (the
+    session locks its model).
+    """
+    preview_original, preview_result, preview_percentage = processor.preview(AppConfig.get('PREVIEW_MAX_SIDE'))
+    preview = st.empty()
+    with preview.container():
+        display_results(preview_original, preview_result, preview_percentage)
+        status = st.empty()
+
+    future = background_executor().submit(processor)
+    start = time.perf_counter()
+    try:
+        while not future.done():
+            # Any element update lets Streamlit stop this run when the user changes the inputs
+            status.caption(f"Preview at reduced resolution - refining at full resolution "
+                           f"({time.perf_counter() - start:.0f}s)")
+            time.sleep(0.25)
+    finally:
+        future.cancel()
+
+    preview.empty()
+    return future.result()
+
+
 def main():
     # Configure page
     st.set_page_config(
@@ -49,47 +157,144 @@ def main():
     render_header()
 
     # File upload and material selection
-    uploaded_file, material_selection = file_uploader()
-    temp_path = None
+    uploaded_files, material_selection = file_uploader()
 
-    if uploaded_file:
-        try:
-            # Validate upload
-            validate_upload(uploaded_file)
+    log_startup_time()
+    if AppConfig.get('PREWARM_ENGINE'):
+        prewarm_engine()
+
+    if len(uploaded_files) == 1:
+        process_single(uploaded_files[0], material_selection)
+    elif uploaded_files:
+        process_batch(uploaded_files, material_selection)
 
-            # Create temporary file
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as temp_file:
-                temp_file.write(uploaded_file.getbuffer())
-                temp_path = temp_file.name
 
-            # Process image with selected material detection mode
-            processor = ImageProcessor(temp_path, material_selection=material_selection)
+def process_single(uploaded_file, material_selection):
+    """Analyzes one upload and shows the original next to the segmented image."""
+    try:
+        from processing.image_processor import ImageProcessor
+        from processing.persistence import default_writer
+        from processing.store import default_store
 
-            # Show progress
+        # Validate upload
+        validate_upload(uploaded_file)
+
+        # Process image with selected material detection mode, decoded straight from the upload
+        writer = default_writer()
+        processor = ImageProcessor(
+            uploaded_file.getvalue(),
+            material_selection=material_selection,
+            session=clustering_session(),
+            store=default_store(),
+            writer=writer,
+        )
+
+        # Show progress, with a low-resolution preview first for large images
+        if wants_preview(processor):
+            result, percentage = analyze_progressively(processor)
+        else:
             with st.spinner("Analyzing image..."):
                 result, percentage = processor()
 
-            # Display results
-            display_results(processor.original_image, result, percentage)
+        # Display results
+        display_results(processor.original_image, result, percentage)
+
+        # Encode once for both the saved file and the download
+        with processor.profile.stage('encode'):
+            encoded = encoded_output(processor, result)
+
+        # Save segmented image, written in the background
+        with processor.profile.stage('save'):
+            save_file = save_segmented_image(
+                result, uploaded_file.name, percentage,
+                result_key=processor.cache_key, store=processor.store,
+                encoded=encoded, writer=writer,
+            )
+
+        # Download button
+        create_download_button(encoded, uploaded_file.name, percentage)
 
-            # Save segmented image
-            save_file = save_segmented_image(result, uploaded_file.name, percentage)
+        # Success message; with the write-behind queue the file is written shortly after
+        saved = "queued for saving at" if writer is not None else "saved at"
+        st.success(f"Image successfully processed and {saved} {save_file}")
+        logger.info(f"Image processed: {save_file}, Material: {percentage:.2f}%, Mode: {material_selection}")
+        processor.profile.log(
+            logger, file=uploaded_file.name, size=processor.original_image.shape[:2],
+            cache_hit=processor.cache_hit,
+        )
 
-            # Download button
-            create_download_button(result, uploaded_file.name, percentage)
+        if AppConfig.get('SHOW_STAGE_PROFILE'):
+            display_stage_profile(processor.profile.as_records())
 
-            # Success message
-            st.success(f"Image successfully processed and saved at {save_file}")
-            logger.info(f"Image processed: {save_file}, Material: {percentage:.2f}%, Mode: {material_selection}")
+    except Exception as e:
+        st.error(f"Processing error: {str(e)}")
+        logger.exception("Application error")
 
-        except Exception as e:
-            st.error(f"Processing error: {str(e)}")
-            logger.exception("Application error")
+
+def process_batch(uploaded_files, material_selection):
+    """
+    Analyzes several uploads on the background pool, updating the per-image
+    status as each completes, then offers the masks and coverages for download.
+    """
+    from concurrent.futures import as_completed
+    from processing.batch import BatchItem, batch_threads, coverage_csv, masks_zip, process_upload
+    from processing.persistence import default_writer
+    from processing.store import default_store
+
+    file_names = [uploaded_file.name for uploaded_file in uploaded_files]
+    st.divider()
+    status = st.empty()
+
+    # Reruns of an unchanged batch (e.g. after a download) reuse its results
+    batch_key = (material_selection, tuple(uploaded_file.file_id for uploaded_file in uploaded_files))
+    if st.session_state.get('batch_key') == batch_key:
+        items = st.session_state['batch_items']
+    else:
+        items = [None] * len(uploaded_files)
+        progress = st.progress(0.0, text=f"Analyzing {len(items)} images...")
+        display_batch_status(status, file_names, items)
+
+        _, threads = batch_threads()
+        store = default_store()
+        futures = {}
+        for index, uploaded_file in enumerate(uploaded_files):
+            try:
+                validate_upload(uploaded_file)
+            except ValueError as e:
+                items[index] = BatchItem(file_name=uploaded_file.name, error=str(e))
+                continue
+            future = background_executor().submit(
+                process_upload, uploaded_file.getvalue(), uploaded_file.name,
+                material_selection, store, threads, default_writer(),
+            )
+            futures[future] = index
+
+        try:
+            for future in as_completed(futures):
+                items[futures[future]] = future.result()
+                completed = sum(item is not None for item in items)
+                progress.progress(completed / len(items), text=f"{completed}/{len(items)} images analyzed")
+                display_batch_status(status, file_names, items)
         finally:
-            # Cleanup temporary file
-            if temp_path and os.path.exists(temp_path):
-                os.remove(temp_path)
-                logger.info(f"Temporary file deleted: {temp_path}")
+            # A rerun interrupting the batch drops the images still queued
+            for future in futures:
+                future.cancel()
+
+        progress.empty()
+        st.session_state['batch_key'] = batch_key
+        st.session_state['batch_items'] = items
+
+    display_batch_status(status, file_names, items)
+
+    failed = [item for item in items if item.error]
+    succeeded = len(items) - len(failed)
+    if succeeded:
+        create_batch_downloads(masks_zip(items), coverage_csv(items))
+        saved = "queued for saving in" if default_writer() is not None else "saved in"
+        st.success(f"{succeeded} images successfully processed and {saved} {AppConfig.get('SAVE_DIR')}")
+    for item in failed:
+        st.error(f"{item.file_name}: {item.error}")
+    logger.info(f"Batch processed: {succeeded}/{len(items)} images, Mode: {material_selection}")
 
 
 if __name__ == "__main__":
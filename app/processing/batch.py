@@ -0,0 +1,141 @@
+"""
+Several uploaded images processed concurrently on a bounded thread pool, with
+per-image results collected into a zip of masks and a coverage CSV.
+"""
+import io
+import os
+import csv
+import time
+import logging
+import zipfile
+
+from contextlib import nullcontext
+from dataclasses import asdict, dataclass
+from typing import Iterable, Optional, Tuple
+from config import AppConfig
+from .image_io import encode_mask_png
+from .image_processor import ImageProcessor
+from .persistence import encode_output
+from .security import save_segmented_image
+
+COVERAGE_FIELDS = ["file_name", "coverage_percentage", "material_percentage", "width", "height",
+                   "cache_hit", "seconds", "saved_path", "error"]
+
+
+@dataclass
+class BatchItem:
+    """Outcome of one image of a batch; `error` is set instead of the result on failure."""
+    file_name: str
+    material_percentage: Optional[float] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    cache_hit: bool = False
+    seconds: float = 0.0
+    saved_path: Optional[str] = None
+    error: Optional[str] = None
+    mask_png: Optional[bytes] = None
+
+    @property
+    def coverage_percentage(self) -> Optional[float]:
+        """Coverage as shown by the app's Material Coverage metric."""
+        if self.material_percentage is None:
+            return None
+        return round(100 - self.material_percentage, 4)
+
+    def record(self) -> dict:
+        """CSV/table row of the item (everything but the mask)."""
+        record = {field: value for field, value in asdict(self).items() if field in COVERAGE_FIELDS}
+        record['coverage_percentage'] = self.coverage_percentage
+        return record
+
+
+def batch_threads() -> Tuple[int, int]:
+    """
+    (workers, threads_per_image): images processed at once and the BLAS/OpenMP
+    threads each of them may use, so that together they stay within the CPUs.
+    """
+    cpus = os.cpu_count() or 1
+    workers = AppConfig.get('BATCH_WORKERS') or cpus
+    return workers, max(1, cpus // workers)
+
+
+def process_upload(data: bytes, file_name: str, material_selection: str = 'auto',
+                   store=None, threads: Optional[int] = None, writer=None) -> BatchItem:
+    """
+    Segments and saves one image of a batch. Runs in a pool thread and never
+    raises: failures are reported on the returned item.
+
+    Args:
+        data: Encoded image bytes
+        file_name: Uploaded file name, used for the saved output and the reports
+        material_selection: 'auto', 'bright' or 'dark'
+        store: Optional ResultStore shared by the batch
+        threads: OpenMP threads this image may use (None = no limit)
+        writer: Optional WriteBehindQueue saving the output and stored result in the background
+    """
+    start = time.perf_counter()
+    try:
+        if threads:
+            from threadpoolctl import threadpool_limits
+
+            # OpenMP limits are per thread, so each pool thread gets its own share
+            limits = threadpool_limits(limits=threads, user_api="openmp")
+        else:
+            limits = nullcontext()
+
+        with limits:
+            processor = ImageProcessor(data, material_selection=material_selection, store=store, writer=writer)
+            labels, percentage = processor.segment_packed()
+            result = processor.composite(labels)
+            encoded = encode_output(result, labels)
+            saved_path = save_segmented_image(
+                result, file_name, percentage, result_key=processor.cache_key, store=store,
+                encoded=encoded, writer=writer,
+            )
+            # The saved output already is the material mask in the 'mask' format
+            mask_png = encoded.data if AppConfig.get('OUTPUT_FORMAT') == 'mask' \
+                else encode_mask_png(labels.material_mask())
+
+        height, width = labels.shape
+        return BatchItem(
+            file_name=file_name,
+            material_percentage=round(float(percentage), 4),
+            width=width,
+            height=height,
+            cache_hit=processor.cache_hit,
+            seconds=round(time.perf_counter() - start, 3),
+            saved_path=saved_path,
+            mask_png=mask_png,
+        )
+    except Exception as e:
+        logging.exception(f"Batch item failed: {file_name}")
+        return BatchItem(file_name=file_name, seconds=round(time.perf_counter() - start, 3), error=str(e))
+
+
+def masks_zip(items: Iterable[BatchItem]) -> bytes:
+    """Zip of the 1-bit mask PNG of every successful item, named after its upload."""
+    buffer = io.BytesIO()
+    used = set()
+    # PNGs are already compressed: store them as they are
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        for item in items:
+            if item.mask_png is None:
+                continue
+            stem = os.path.splitext(os.path.basename(item.file_name))[0] or "image"
+            name, suffix = f"{stem}_mask.png", 1
+            while name in used:
+                suffix += 1
+                name = f"{stem}_{suffix}_mask.png"
+            used.add(name)
+            archive.writestr(name, item.mask_png)
+    return buffer.getvalue()
+
+
+def coverage_csv(items: Iterable[BatchItem]) -> str:
+    """CSV with one row per item: coverage, size, timing, output path or error."""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=COVERAGE_FIELDS)
+    writer.writeheader()
+    writer.writerows(item.record() for item in items)
+    return buffer.getvalue()
+
@@ -0,0 +1,98 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+from config import AppConfig
+
+
+def hash_image(image) -> str:
+    """
+    SHA-256 of the image content.
+
+    Args:
+        image: Encoded image bytes, a uint8 array, or a path to the image file
+    """
+    digest = hashlib.sha256()
+
+    if isinstance(image, np.ndarray):
+        digest.update(f"{image.shape}{image.dtype}".encode())
+        digest.update(memoryview(np.ascontiguousarray(image)).cast("B"))
+    elif isinstance(image, (str, os.PathLike)):
+        with open(image, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    else:
+        digest.update(image)
+    return digest.hexdigest()
+
+
+def make_cache_key(image, params: Dict[str, Any], image_hash: Optional[str] = None) -> str:
+    """
+    Builds a content-addressed key from the image data and the algorithm parameters.
+
+    Args:
+        image: Encoded image bytes, a uint8 array, or a path to the image file
+        params: Everything that influences the segmentation (selection mode, engines, ...)
+        image_hash: hash_image(image) when already known, to avoid hashing twice
+    """
+    digest = hashlib.sha256((image_hash or hash_image(image)).encode())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Thread-safe LRU cache whose entries are evicted to stay under a byte budget."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Returns the cached value and marks it as most recently used."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, nbytes: int) -> bool:
+        """
+        Stores `value`, evicting least recently used entries until it fits.
+        Returns False when the value alone exceeds the budget and is not stored.
+        """
+        if nbytes > self.max_bytes:
+            return False
+
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+
+            while self._entries and self.current_bytes + nbytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_bytes
+
+            self._entries[key] = (value, nbytes)
+            self.current_bytes += nbytes
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+
+# Process-wide cache of segmentation results shared by every ImageProcessor
+result_cache = ResultCache(AppConfig.get('RESULT_CACHE_BYTES'))
@@ -0,0 +1,282 @@
+import os
+import numpy as np
+
+from typing import Optional, Tuple
+
+GRAY_LEVELS = 256
+
+# `init` value selecting two_means_init seeds in fit_kmeans
+SEEDED_INIT = 'seeded'
+
+
+def gray_histogram(img_gray: np.ndarray) -> np.ndarray:
+    """Returns the 256-bin intensity histogram of a uint8 grayscale image."""
+    return np.bincount(img_gray.ravel(), minlength=GRAY_LEVELS).astype(np.int64)
+
+
+def histogram_kmeans_1d(hist: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Exact two-cluster K-Means on a weighted 1-D intensity histogram.
+
+    In one dimension every optimal two-cluster partition is a threshold, so
+    instead of running Lloyd iterations the within-cluster sum of squares is
+    evaluated for all 255 thresholds from cumulative sums and the global
+    minimum is taken. The cost depends on the number of bins, not pixels.
+
+    Args:
+        hist: Pixel counts per intensity level (length 256)
+
+    Returns:
+        lut: uint8 lookup table mapping intensity -> cluster label
+             (0 = darker cluster, 1 = brighter cluster)
+        centers: Cluster centers with shape (2, 1), like KMeans.cluster_centers_
+        counts: Number of pixels in each cluster
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    levels = np.arange(len(hist), dtype=np.float64)
+
+    # Cumulative weight, sum and sum of squares of the lower cluster for a
+    # threshold placed after each level
+    w_low = np.cumsum(hist)
+    s_low = np.cumsum(hist * levels)
+    q_low = np.cumsum(hist * levels ** 2)
+    w_total, s_total, q_total = w_low[-1], s_low[-1], q_low[-1]
+
+    w_high = w_total - w_low
+    s_high = s_total - s_low
+
+    # SSE = sum(x^2) - (sum x)^2 / n for each side; empty sides are invalid
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sse = q_total - s_low ** 2 / w_low - s_high ** 2 / w_high
+    sse[(w_low == 0) | (w_high == 0)] = np.inf
+
+    if not np.isfinite(sse).any():
+        # Fewer than two distinct intensities: everything is one cluster
+        threshold = len(hist) - 1
+        center = s_total / w_total if w_total else 0.0
+        centers = np.array([[center], [center]])
+    else:
+        threshold = int(np.argmin(sse))
+        centers = np.array([
+            [s_low[threshold] / w_low[threshold]],
+            [s_high[threshold] / w_high[threshold]],
+        ])
+
+    lut = (levels > threshold).astype(np.uint8)
+    counts = np.array([w_low[threshold], w_total - w_low[threshold]], dtype=np.int64)
+    return lut, centers, counts
+
+
+def unique_colors(pixels: np.ndarray, color_bits: int = 8) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Collapses (N, 3) uint8 pixels to their distinct colors.
+
+    Args:
+        pixels: RGB pixels with shape (N, 3)
+        color_bits: Bits kept per channel; values below 8 quantize the colors
+                    to a fixed-precision palette before deduplication
+
+    Returns:
+        palette: Distinct (quantized) colors as float32, shape (M, 3)
+        inverse: Index into the palette for every input pixel
+        counts: Number of pixels per palette color (usable as sample_weight)
+    """
+    if not 1 <= color_bits <= 8:
+        raise ValueError(f"color_bits must be between 1 and 8, got {color_bits}")
+
+    shift = 8 - color_bits
+    channels = (pixels >> shift).astype(np.uint32) if shift else pixels.astype(np.uint32)
+    keys = (channels[:, 0] << (2 * color_bits)) | (channels[:, 1] << color_bits) | channels[:, 2]
+
+    key_space = 1 << (3 * color_bits)
+    if key_space <= len(keys):
+        # Dense key space relative to the pixel count: a bincount is O(N) and
+        # avoids sorting every pixel
+        all_counts = np.bincount(keys, minlength=key_space)
+        palette_keys = np.flatnonzero(all_counts).astype(np.uint32)
+        counts = all_counts[palette_keys]
+        index = np.zeros(key_space, dtype=np.int32)
+        index[palette_keys] = np.arange(len(palette_keys), dtype=np.int32)
+        inverse = index[keys]
+    else:
+        palette_keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+
+    mask = (1 << color_bits) - 1
+    palette = np.stack([
+        (palette_keys >> (2 * color_bits)) & mask,
+        (palette_keys >> color_bits) & mask,
+        palette_keys & mask,
+    ], axis=1).astype(np.float32)
+    if shift:
+        # Represent each quantization bin by its center
+        palette = palette * (1 << shift) + ((1 << shift) - 1) / 2
+
+    return palette, inverse.ravel(), counts
+
+
+def two_means_init(X: np.ndarray, sample_weight: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Deterministic seeds for two-cluster K-Means.
+
+    The points are projected on candidate axes (the principal axes and, for
+    colors, the channel axes) and each projection is split with the exact
+    histogram 2-means. The split that separates the weighted centroids most,
+    i.e. leaves the lowest within-cluster sum of squares, gives the seeds. For
+    grayscale pixels this is the exact optimum, for colors it starts Lloyd next
+    to it, so one run replaces the random restarts.
+
+    Args:
+        X: (N, D) points; uint8 grayscale or RGB pixels are collapsed to a
+           histogram / their distinct colors first
+        sample_weight: Optional (N,) weights
+
+    Returns:
+        (2, D) float64 seeds
+    """
+    if X.dtype == np.uint8 and sample_weight is None:
+        if X.shape[1] == 1:
+            return histogram_kmeans_1d(gray_histogram(X))[1]
+        if X.shape[1] == 3:
+            X, _, sample_weight = unique_colors(X)
+
+    X = np.asarray(X, dtype=np.float64)
+    weights = np.ones(len(X)) if sample_weight is None else np.asarray(sample_weight, dtype=np.float64)
+    if not len(X) or weights.sum() <= 0:
+        raise ValueError("Cannot seed K-Means on an empty set of points")
+    mean = np.average(X, axis=0, weights=weights)
+    centered = X - mean
+
+    axes = np.eye(X.shape[1])
+    if X.shape[1] > 1:
+        # With nearly isotropic clouds the principal axes are arbitrary, so the
+        # channel axes stay candidates as well
+        covariance = (centered * weights[:, np.newaxis]).T @ centered / weights.sum()
+        axes = np.concatenate([np.linalg.eigh(covariance)[1].T, axes])
+
+    best, best_separation = None, -1.0
+    for axis in axes:
+        upper = _split_projection(centered @ axis, weights)
+        if upper is None or upper.all():
+            continue
+        w_low, w_high = weights[~upper].sum(), weights[upper].sum()
+        centers = np.stack([
+            np.average(X[~upper], axis=0, weights=weights[~upper]),
+            np.average(X[upper], axis=0, weights=weights[upper]),
+        ])
+        # Between-cluster sum of squares; total minus within-cluster SSE
+        separation = w_low * w_high / (w_low + w_high) * float(((centers[1] - centers[0]) ** 2).sum())
+        if separation > best_separation:
+            best, best_separation = centers, separation
+
+    return best if best is not None else np.repeat(mean[np.newaxis], 2, axis=0)
+
+
+def _split_projection(projection: np.ndarray, weights: np.ndarray) -> Optional[np.ndarray]:
+    """Exact weighted 2-means threshold of a 1-D projection (256 bins); None if constant."""
+    low, high = projection.min(), projection.max()
+    if high == low:
+        return None
+    bins = np.minimum(((projection - low) / (high - low) * GRAY_LEVELS).astype(np.int64), GRAY_LEVELS - 1)
+    lut, _, _ = histogram_kmeans_1d(np.bincount(bins, weights=weights, minlength=GRAY_LEVELS))
+    return lut[bins].astype(bool)
+
+
+def fit_kmeans(kmeans, X: np.ndarray, sample_weight: Optional[np.ndarray] = None,
+               threads: Optional[int] = None):
+    """
+    Fits a KMeans / MiniBatchKMeans estimator in place and returns it.
+
+    - init=SEEDED_INIT (two clusters): a single run from two_means_init seeds
+    - an explicit array init (e.g. a warm start): a single run from it
+    - otherwise the n_init restarts run concurrently, split over a budget of
+      `threads` CPU threads (defaults to every core)
+
+    Raises ValueError when there are fewer points than clusters.
+    """
+    if len(X) < kmeans.n_clusters:
+        raise ValueError(f"Cannot fit {kmeans.n_clusters} clusters on {len(X)} points")
+    if isinstance(kmeans.init, str) and kmeans.init == SEEDED_INIT:
+        n_init = kmeans.n_init
+        kmeans.set_params(init=two_means_init(X, sample_weight), n_init=1)
+        try:
+            return kmeans.fit(X, sample_weight=sample_weight)
+        finally:
+            kmeans.set_params(init=SEEDED_INIT, n_init=n_init)
+
+    threads = threads or os.cpu_count() or 1
+    n_init = kmeans.n_init if isinstance(kmeans.n_init, int) else 1
+    if isinstance(kmeans.init, np.ndarray) or n_init < 2 or threads < 2:
+        return kmeans.fit(X, sample_weight=sample_weight)
+    return _parallel_restarts(kmeans, X, sample_weight, n_init, threads)
+
+
+def _parallel_restarts(kmeans, X, sample_weight, n_init: int, threads: int):
+    """Runs single-init copies of `kmeans` in threads and keeps the lowest inertia."""
+    from concurrent.futures import ThreadPoolExecutor
+    from sklearn.base import clone
+    from threadpoolctl import threadpool_limits
+
+    seeds = np.random.RandomState(kmeans.random_state).randint(np.iinfo(np.int32).max, size=n_init)
+    runs = [clone(kmeans).set_params(n_init=1, random_state=int(seed)) for seed in seeds]
+    workers = min(threads, n_init)
+    threads_per_run = max(1, threads // workers)
+
+    def run(estimator):
+        # sklearn's Lloyd/Elkan loops release the GIL; OpenMP limits are per thread
+        with threadpool_limits(limits=threads_per_run, user_api="openmp"):
+            return estimator.fit(X, sample_weight=sample_weight)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        best = min(pool.map(run, runs), key=lambda estimator: estimator.inertia_)
+
+    # Expose the winning run (fitted and private state alike) through the caller's
+    # estimator, which keeps its own parameters
+    params = kmeans.get_params()
+    kmeans.__dict__.update(vars(best))
+    return kmeans.set_params(**params)
+
+
+def weighted_color_kmeans(kmeans, pixels: np.ndarray, color_bits: int = 8,
+                          threads: Optional[int] = None) -> np.ndarray:
+    """
+    Fits `kmeans` on the distinct colors of `pixels` weighted by their pixel
+    counts and returns the uint8 label of every input pixel.
+    """
+    palette, inverse, counts = unique_colors(pixels, color_bits)
+    if len(palette) < kmeans.n_clusters:
+        # Too few distinct colors to seed every cluster from the palette
+        fit_kmeans(kmeans, pixels, threads=threads)
+        return kmeans.labels_.astype(np.uint8)
+    fit_kmeans(kmeans, palette, sample_weight=counts, threads=threads)
+    return kmeans.labels_.astype(np.uint8)[inverse]
+
+
+def assign_nearest(pixels: np.ndarray, centers: np.ndarray) -> np.ndarray:
+    """Labels each row of `pixels` with the index of its nearest center (uint8)."""
+    pixels = pixels.astype(np.float32, copy=False)
+    centers = np.asarray(centers, dtype=np.float32)
+    # |p - c|^2 = |p|^2 - 2 p.c + |c|^2; |p|^2 is the same for every center
+    distances = (centers ** 2).sum(axis=1) - 2 * pixels @ centers.T
+    return np.argmin(distances, axis=1).astype(np.uint8)
+
+
+def stratified_sample(shape: Tuple[int, int], size: int, rng: np.random.Generator,
+                      grid: int = 8) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Draws about `size` pixel positions spread evenly over a grid x grid
+    partition of the image, so every region contributes in proportion to its area.
+
+    Returns:
+        rows, cols: Index arrays of the sampled positions
+    """
+    height, width = shape
+    row_edges = np.linspace(0, height, min(grid, height) + 1).astype(np.int64)
+    col_edges = np.linspace(0, width, min(grid, width) + 1).astype(np.int64)
+
+    rows, cols = [], []
+    for y0, y1 in zip(row_edges[:-1], row_edges[1:]):
+        for x0, x1 in zip(col_edges[:-1], col_edges[1:]):
+            k = int(round(size * (y1 - y0) * (x1 - x0) / (height * width)))
+            rows.append(rng.integers(y0, y1, size=k))
+            cols.append(rng.integers(x0, x1, size=k))
+    return np.concatenate(rows), np.concatenate(cols)
@@ -0,0 +1,88 @@
+import os
+import cv2
+import numpy as np
+
+from typing import BinaryIO, Tuple, Union
+
+ImageSource = Union[str, os.PathLike, bytes, bytearray, memoryview, BinaryIO, np.ndarray]
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+
+def read_image_source(source: ImageSource) -> Union[bytes, np.ndarray, str, os.PathLike]:
+    """Reads file-like objects into bytes; paths, buffers and arrays pass through."""
+    if hasattr(source, "getvalue"):
+        return source.getvalue()
+    if hasattr(source, "read"):
+        return source.read()
+    return source
+
+
+def decode_image(source: ImageSource) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Decodes an image once and derives both representations used by the segmenter.
+
+    Args:
+        source: Path, encoded bytes, file-like object, or an RGB/grayscale uint8 array
+
+    Returns:
+        img_rgb: (H, W, 3) uint8 RGB image
+        img_gray: (H, W) uint8 grayscale image
+    """
+    source = read_image_source(source)
+
+    if isinstance(source, np.ndarray):
+        return _from_array(source)
+
+    if isinstance(source, (str, os.PathLike)):
+        buffer = np.fromfile(source, dtype=np.uint8)
+    else:
+        buffer = np.frombuffer(source, dtype=np.uint8)
+
+    img_bgr = cv2.imdecode(buffer, cv2.IMREAD_COLOR) if buffer.size else None
+    if img_bgr is None:
+        raise ValueError("Could not decode image data")
+
+    return cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB), cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
+
+
+def preview_level(image: np.ndarray, max_side: int) -> np.ndarray:
+    """
+    Pyramid level of `image` whose longest side is at most `max_side`, taking
+    every 2**k-th pixel.
+
+    Point sampling keeps the intensity distribution the coverage estimate
+    depends on; area averaging would blend thin features with their
+    surroundings into intermediate colors and bias the clustering.
+    """
+    step = 1
+    while max(image.shape[:2]) > max_side * step:
+        step *= 2
+    if step == 1:
+        return image
+    return np.ascontiguousarray(image[step // 2::step, step // 2::step])
+
+
+def _from_array(image: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Normalizes an in-memory RGB(A) or grayscale array."""
+    if image.dtype != np.uint8:
+        raise ValueError(f"Expected a uint8 image, got {image.dtype}")
+
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2RGB), image
+    if image.ndim == 3 and image.shape[2] == 4:
+        image = cv2.cvtColor(image, cv2.COLOR_RGBA2RGB)
+    elif image.ndim != 3 or image.shape[2] != 3:
+        raise ValueError(f"Unsupported image shape: {image.shape}")
+
+    return image, cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+
+
+def encode_mask_png(mask: np.ndarray) -> bytes:
+    """Encodes a boolean or 0/1 mask as a 1-bit PNG."""
+    ok, buffer = cv2.imencode(
+        ".png", mask.astype(np.uint8) * 255, [cv2.IMWRITE_PNG_BILEVEL, 1]
+    )
+    if not ok:
+        raise ValueError("Could not encode mask")
+    return buffer.tobytes()
@@ -1,78 +1,176 @@
 import logging
 import numpy as np
-import streamlit as st
 
-from typing import Tuple
-from .model import Segmenter
+from functools import partial
+from typing import Optional, Tuple
+from config import AppConfig
+from .model import Segmenter, LABEL_REJECTED
+from .labels import PackedLabels
+from .image_io import ImageSource, preview_level, read_image_source
+from .cache import ResultCache, hash_image, make_cache_key, result_cache
+from .profiling import StageProfiler
+from .session import ClusteringSession
+from .store import ResultStore
 
 class ImageProcessor:
-    def __init__(self, image_bytes: str, material_selection: str = 'auto'):
+    def __init__(self, image_bytes: ImageSource, material_selection: str = 'auto',
+                 cache: Optional[ResultCache] = None, session: Optional[ClusteringSession] = None,
+                 store: Optional[ResultStore] = None, writer=None):
         """
         Args:
-            image_bytes: Path to the image file
+            image_bytes: Encoded image bytes, a file-like object, an RGB uint8 array,
+                         or a path to the image file
             material_selection: How to identify material cluster
-                - 'auto': Use the smaller cluster (assumes material < 50% of image)
+                - 'auto': The app's default, the brighter cluster (as 'bright')
                 - 'bright': Use the brighter cluster
                 - 'dark': Use the darker cluster
+            cache: Result cache to use (defaults to the process-wide cache)
+            session: ClusteringSession shared by the images of one acquisition
+                     session to warm-start the clustering
+            store: Persistent ResultStore consulted after the in-memory cache
+                   (nothing is persisted when None)
+            writer: WriteBehindQueue writing new results to `store` in the
+                    background (written synchronously when None)
+
+        `profile` records the duration (and with PROFILE_MEMORY, the allocated
+        bytes) of every stage run for
+        this image (decode, cache_key, first_pass, masks, second_pass, pack, store,
+        composite, and preview when requested);
+        callers add their own stages, such as saving, with `profile.stage(name)`.
         """
-        self.image_path = image_bytes
+        self.profile = StageProfiler(track_memory=AppConfig.get('PROFILE_MEMORY'))
+        self.image = read_image_source(image_bytes)
         self.material_selection = material_selection
-        self.segmenter = self._load_segmenter(self.image_path, self.material_selection)
+        self.segmenter = Segmenter(
+            self.image,
+            'bright' if material_selection == 'auto' else material_selection,
+            fit_sample=AppConfig.get('FIT_SAMPLE_SIZE'),
+            sample_seed=AppConfig.get('FIT_SAMPLE_SEED'),
+            init=AppConfig.get('KMEANS_INIT'),
+            threads=AppConfig.get('KMEANS_THREADS'),
+            profile=self.profile,
+            session=session,
+        )
         self.original_image = self.segmenter.img_rgb
+        self.cache = result_cache if cache is None else cache
+        self.store = store
+        self.writer = writer
+        with self.profile.stage('cache_key'):
+            self.image_hash = hash_image(self.image)
+            self.cache_key = make_cache_key(self.image, self.segmenter.params(), self.image_hash)
+        self.cache_hit = False
+        self.labels: Optional[PackedLabels] = None
+
+    def segment_packed(self) -> Tuple[PackedLabels, float]:
+        """
+        Returns the bit-packed labels and material percentage, from the in-memory
+        cache or the persistent store when possible. Both keep the packed form.
+        The labels are also kept in `labels`.
+        """
+        cached = self.cache.get(self.cache_key)
+        if cached is not None:
+            logging.info(f"Result cache hit: {self.cache_key[:12]}")
+            self.cache_hit = True
+            self.labels = cached[0]
+            return cached
+
+        stored = self.store.get(self.cache_key) if self.store is not None else None
+        if stored is not None:
+            logging.info(f"Result store hit: {self.cache_key[:12]}")
+            self.cache_hit = True
+            labels, material_percentage = stored
+        else:
+            result = self.segmenter.segment()
+            material_percentage = result.material_percentage
+            with self.profile.stage('pack'):
+                labels = PackedLabels.pack(result.label_map)
+            del result
+            if self.store is not None:
+                with self.profile.stage('store'):
+                    self._store_result(labels, material_percentage)
+
+        self.cache.put(self.cache_key, (labels, material_percentage), labels.nbytes)
+        self.labels = labels
+        return labels, material_percentage
+
+    def _store_result(self, labels: PackedLabels, material_percentage: float):
+        put = partial(self.store.put, self.cache_key, self.image_hash, self.segmenter.params(),
+                      labels, material_percentage)
+        if self.writer is None:
+            put()
+        else:
+            self.writer.submit(put, key=('store', self.cache_key))
+
+    def segment(self) -> Tuple[np.ndarray, float]:
+        """Returns the uint8 label map and material percentage (see segment_packed)."""
+        labels, material_percentage = self.segment_packed()
+        return labels.unpack(), material_percentage
+
+    def has_result(self) -> bool:
+        """True when segment() will be served by the cache or the persistent store."""
+        if self.cache.get(self.cache_key) is not None:
+            return True
+        return self.store is not None and self.store.contains(self.cache_key)
+
+    def preview(self, max_side: int = 512) -> Tuple[np.ndarray, np.ndarray, float]:
+        """
+        Fast low-resolution result: the full pipeline on a pyramid level of the
+        image (see preview_level). Nothing is cached.
+
+        Returns:
+            (preview_original, preview_result, material_percentage)
+        """
+        with self.profile.stage('preview'):
+            small = preview_level(self.original_image, max_side)
+            result = Segmenter(
+                small,
+                self.segmenter.material_selection,
+                init=self.segmenter.init,
+                threads=self.segmenter.threads,
+                headless=True,
+            ).segment()
+            combined_result = small.copy()
+            combined_result[result.label_map == LABEL_REJECTED] = 0
+        return small, combined_result, result.material_percentage
+
+    def composite(self, labels: PackedLabels) -> np.ndarray:
+        """
+        Overlay: background from the first pass plus the refined material from the
+        second pass. Only first-pass material outside the refined cluster is blacked
+        out, so the result is a single copy of the original with that mask cleared.
+        """
+        with self.profile.stage('composite'):
+            combined_result = self.original_image.copy()
+            combined_result[labels.rejected_mask()] = 0
+        return combined_result
 
-    @staticmethod
-    @st.cache_resource
-    def _load_segmenter(image_path, material_selection):
-        """Load and cache the segmentation model."""
-        return Segmenter(image_path, material_selection)
+    def __call__(self, return_profile: bool = False):
+        """
+        Main processing pipeline with caching.
 
-    # @st.cache_data(max_entries=3, ttl=AppConfig.get('CACHE_TIMEOUT'))
-    def __call__(self) -> Tuple[np.ndarray, float]:
-        """Main processing pipeline with caching."""
+        Returns (combined_result, material_percentage), followed by the stage
+        records of `profile` when `return_profile` is True.
+        """
         try:
-            segmenter = self.segmenter
-
-            pixels = segmenter._load_image()
-
-            label2d, cluster_centers = segmenter._kmeans_first_pass(
-                pixels
-            )
-            avg_intensity = cluster_centers.flatten()
-            material_cluster = np.argmax(avg_intensity)
-            binary_mask = (label2d == material_cluster).astype(np.uint8)
-
-            segmented_image_material_first = segmenter.img_rgb.copy()
-            segmented_image_background_first = segmenter.img_rgb.copy()
-            segmented_image_material_first[binary_mask == 0] = [0, 0, 0]
-            segmented_image_background_first[binary_mask == 1] = [0, 0, 0]
-
-            new_labels_2d = segmenter._second_segmentation(segmented_image_material_first)
-
-            second_centers = segmenter.second_kmeans.cluster_centers_
-            avg_color_intensity = np.sum(second_centers, axis=1)
-            material_cluster_2 = np.argmax(avg_color_intensity)
-
-            material_mask_2 = new_labels_2d == material_cluster_2
-            segmented_image_material_second = segmented_image_material_first.copy()
-            segmented_image_background_second = segmented_image_material_first.copy()
-            segmented_image_material_second[~material_mask_2] = [0, 0, 0]
-            segmented_image_background_second[material_mask_2] = [0, 0, 0]
-
-            # Overlay: Start with background from first pass, then add the refined material from second pass
-            # This creates a visualization showing all non-material (background) + refined material boundaries
-            combined_result = segmented_image_background_first.copy()
-            # Overlay the refined material segmentation from the second pass
-            material_mask_second = np.any(segmented_image_material_second != [0, 0, 0], axis=-1)
-            combined_result[material_mask_second] = segmented_image_material_second[material_mask_second]
-
-            # Calculate material percentage based on ALL material from first pass (not refined second pass)
-            total_pixels = segmenter.img_gray.size
-            material_mask_first = np.any(segmented_image_material_first != [0, 0, 0], axis=-1)
-            material_pixels = np.count_nonzero(material_mask_first)
-            material_percentage = (material_pixels / total_pixels) * 100
+            labels, material_percentage = self.segment_packed()
+            combined_result = self.composite(labels)
 
+            if return_profile:
+                return combined_result, material_percentage, self.profile.as_records()
             return combined_result, material_percentage
 
         except Exception as e:
             logging.error(f"Processing failed: {str(e)}")
             raise
+
+
+def warm_up():
+    """
+    Runs the pipeline once on a small synthetic image so that the first real
+    image does not pay for imports, BLAS/OpenMP thread start-up and the first
+    sklearn fit. Nothing is cached.
+    """
+    rng = np.random.default_rng(0)
+    image = np.where(rng.random((64, 64, 1)) < 0.3, 190, 60).astype(np.uint8)
+    image = np.repeat(image, 3, axis=2) + rng.integers(0, 20, (64, 64, 3), dtype=np.uint8)
+    ImageProcessor(image, cache=ResultCache(0))()
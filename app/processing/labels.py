@@ -0,0 +1,79 @@
+import zipfile
+import numpy as np
+
+from dataclasses import dataclass
+from typing import Tuple
+
+# Values of the label map produced by the full two-pass pipeline
+LABEL_BACKGROUND = 0  # First-pass background, shown with its original color
+LABEL_MATERIAL = 1    # Material kept by the second pass
+LABEL_REJECTED = 2    # First-pass material dropped by the second pass, shown black
+
+
+@dataclass(frozen=True)
+class PackedLabels:
+    """
+    A label map as two bit planes packed with np.packbits, 2 bits per pixel
+    instead of the 8 of a uint8 label map:
+
+    - material: first-pass material (label != LABEL_BACKGROUND)
+    - rejected: material dropped by the second pass (label == LABEL_REJECTED)
+
+    Masks and the label map are unpacked on demand.
+    """
+    shape: Tuple[int, int]
+    material: np.ndarray
+    rejected: np.ndarray
+
+    @classmethod
+    def pack(cls, label_map: np.ndarray) -> "PackedLabels":
+        packed = cls(
+            shape=tuple(int(n) for n in label_map.shape),
+            material=np.packbits(label_map != LABEL_BACKGROUND),
+            rejected=np.packbits(label_map == LABEL_REJECTED),
+        )
+        packed.material.setflags(write=False)
+        packed.rejected.setflags(write=False)
+        return packed
+
+    @property
+    def nbytes(self) -> int:
+        return self.material.nbytes + self.rejected.nbytes
+
+    def _unpack(self, plane: np.ndarray) -> np.ndarray:
+        height, width = self.shape
+        return np.unpackbits(plane, count=height * width).reshape(self.shape)
+
+    def material_mask(self) -> np.ndarray:
+        """(H, W) bool mask of the first-pass material."""
+        return self._unpack(self.material).view(bool)
+
+    def rejected_mask(self) -> np.ndarray:
+        """(H, W) bool mask of the material rejected by the second pass."""
+        return self._unpack(self.rejected).view(bool)
+
+    def unpack(self) -> np.ndarray:
+        """(H, W) uint8 label map with LABEL_* values."""
+        # Rejected pixels are a subset of the material: 0 + 0, 1 + 0 or 1 + 1
+        label_map = self._unpack(self.material)
+        label_map += self._unpack(self.rejected)
+        return label_map
+
+    def save(self, path: str, compresslevel: int = 1):
+        """
+        Writes the planes as an .npz archive (readable with np.load). The fast
+        deflate level already shrinks the long runs of bits several times over.
+        """
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as archive:
+            for name, array in (("shape", np.array(self.shape, dtype=np.int64)),
+                                ("material", self.material), ("rejected", self.rejected)):
+                with archive.open(f"{name}.npy", "w") as member:
+                    np.lib.format.write_array(member, array, allow_pickle=False)
+
+    @classmethod
+    def load(cls, path: str) -> "PackedLabels":
+        with np.load(path) as data:
+            packed = cls(tuple(int(n) for n in data["shape"]), data["material"], data["rejected"])
+        packed.material.setflags(write=False)
+        packed.rejected.setflags(write=False)
+        return packed
@@ -1,28 +1,177 @@
 import os
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
-from sklearn.cluster import KMeans
+from dataclasses import dataclass
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+from .image_io import decode_image
+from .profiling import stage
+from .labels import LABEL_BACKGROUND, LABEL_MATERIAL, LABEL_REJECTED
+from .clustering import (
+    GRAY_LEVELS, SEEDED_INIT, assign_nearest, fit_kmeans, gray_histogram,
+    histogram_kmeans_1d, stratified_sample, weighted_color_kmeans,
+)
+
+# Bump whenever a change alters the label maps produced for the same parameters,
+# so persisted results of older versions are recomputed
+ALGORITHM_VERSION = 2
+
+
+@dataclass
+class SegmentationResult:
+    """Arrays produced by the two-pass pipeline, without any rendering."""
+    label_map: np.ndarray       # (H, W) uint8 with LABEL_* values
+    material_percentage: float  # First-pass material share of the whole image
+    first_centers: np.ndarray   # (2, 1) grayscale centers of the first pass
+    second_centers: np.ndarray  # (2, 3) RGB centers of the second pass
+
+    def overlay(self, img_rgb):
+        """Returns a copy of `img_rgb` with the rejected material blacked out."""
+        combined = img_rgb.copy()
+        combined[self.label_map == LABEL_REJECTED] = 0
+        return combined
+
+
+def select_material_cluster(material_selection, cluster_centers, counts):
+    """Picks the first-pass cluster that represents the material."""
+    if material_selection == 'auto':
+        # Use the smaller cluster (assumes material is minority)
+        return 0 if counts[0] < counts[1] else 1
+    elif material_selection == 'bright':
+        # Use the brighter cluster
+        return int(np.argmax(cluster_centers.flatten()))
+    elif material_selection == 'dark':
+        # Use the darker cluster
+        return int(np.argmin(cluster_centers.flatten()))
+    raise ValueError(f"Invalid material_selection: {material_selection}")
+
+
+def label_pixels(rgb, gray, material_lut, second_centers, material_cluster_2):
+    """
+    Labels pixels with an already fitted two-pass model.
+
+    Args:
+        rgb: (..., 3) uint8 RGB pixels
+        gray: Matching (...) uint8 grayscale pixels
+        material_lut: (256,) bool table of the first-pass material intensities
+        second_centers: (2, 3) RGB centers of the second pass
+        material_cluster_2: Index of the second-pass center kept as material
+
+    Returns:
+        uint8 LABEL_* values with the shape of `gray`
+    """
+    material_mask = material_lut[gray]
+    labels = np.full(gray.shape, LABEL_BACKGROUND, dtype=np.uint8)
+    second_labels = assign_nearest(rgb[material_mask], second_centers)
+    labels[material_mask] = material_labels(second_labels, material_cluster_2)
+    return labels
+
+
+def material_labels(second_labels, material_cluster_2):
+    """uint8 LABEL_MATERIAL / LABEL_REJECTED values of first-pass material pixels."""
+    return np.where(second_labels == material_cluster_2, np.uint8(LABEL_MATERIAL), np.uint8(LABEL_REJECTED))
 
 
 class Segmenter:
-    def __init__(self, image_path, material_selection='auto'):
+    def __init__(self, image, material_selection='auto', first_pass='histogram',
+                 second_pass='unique', color_bits=8, fit_sample=None, sample_seed=42,
+                 minibatch=False, init='seeded', threads=None, headless=False, save_dir=None,
+                 profile=None, session=None):
         """
         Args:
-            image_path: Path to the image file
+            image: Path to the image file, encoded image bytes, a file-like object,
+                   or an RGB/grayscale uint8 array
             material_selection: How to identify material cluster in first pass
                 - 'auto': Use the smaller cluster (assumes material < 50% of image)
                 - 'bright': Use the brighter cluster
                 - 'dark': Use the darker cluster
+            first_pass: Clustering engine for the grayscale pass
+                - 'histogram': Exact 2-means on the 256-bin histogram (cost independent of pixel count)
+                - 'kmeans': sklearn KMeans over every pixel
+            second_pass: Clustering mode for the RGB pass over material pixels
+                - 'unique': Fit on distinct colors weighted by their pixel counts
+                - 'dense': Fit on every material pixel
+            color_bits: Bits per channel kept by the 'unique' mode (8 = exact colors)
+            fit_sample: If set, the K-Means fits use a random sample of about this
+                        many pixels and then label every pixel by nearest center (the
+                        exact 'histogram' first pass always uses every pixel)
+            sample_seed: Seed of the subsample
+            minibatch: Use MiniBatchKMeans instead of KMeans for the fits
+            init: K-Means initialization of both passes
+                - 'seeded': One run from deterministic seeds (see two_means_init)
+                - 'k-means++' / 'random': sklearn's random restarts (10, or 3 with
+                  minibatch), run concurrently
+            threads: CPU threads shared by concurrent restarts (None = every core)
+            headless: If True, __call__ returns a SegmentationResult and never
+                      imports matplotlib
+            save_dir: In headless mode, directory for the mask and overlay PNGs
+                      (nothing is written when None)
+            profile: Optional StageProfiler recording the decode, first_pass,
+                     masks and second_pass stages
+            session: Optional ClusteringSession whose centers from previous images
+                     warm-start the K-Means fits (the exact 'histogram' first pass
+                     needs no warm start)
         """
-        self.image_path = image_path
+        if first_pass not in ('histogram', 'kmeans'):
+            raise ValueError(f"Invalid first_pass: {first_pass}")
+        if second_pass not in ('unique', 'dense'):
+            raise ValueError(f"Invalid second_pass: {second_pass}")
+        if init not in (SEEDED_INIT, 'k-means++', 'random'):
+            raise ValueError(f"Invalid init: {init}")
+
+        self.image_path = image if isinstance(image, (str, os.PathLike)) else None
         self.material_selection = material_selection
-
-        self.img_rgb = cv2.cvtColor(cv2.imread(self.image_path), cv2.COLOR_BGR2RGB)
-        self.img_gray = cv2.imread(self.image_path, cv2.IMREAD_GRAYSCALE)
-
-        self.first_kmeans = KMeans(n_clusters=2, n_init=10, random_state=42)
-        self.second_kmeans = KMeans(n_clusters=2, n_init=10, random_state=42)
+        self.first_pass = first_pass
+        self.second_pass = second_pass
+        self.color_bits = color_bits
+        self.fit_sample = fit_sample
+        self.sample_seed = sample_seed
+        self.minibatch = minibatch
+        self.init = init
+        self.threads = threads
+        self.headless = headless
+        self.save_dir = save_dir
+        self.profile = profile
+        self.session = session
+
+        with stage(profile, 'decode'):
+            self.img_rgb, self.img_gray = decode_image(image)
+
+        estimator, restarts = (MiniBatchKMeans, 3) if minibatch else (KMeans, 10)
+        n_init = 1 if init == SEEDED_INIT else restarts
+        self.first_kmeans = estimator(n_clusters=2, init=init, n_init=n_init, random_state=42)
+        self.second_kmeans = estimator(n_clusters=2, init=init, n_init=n_init, random_state=42)
+
+    def params(self):
+        """Algorithm parameters that determine the segmentation result."""
+        return {
+            'material_selection': self.material_selection,
+            'first_pass': self.first_pass,
+            'second_pass': self.second_pass,
+            'color_bits': self.color_bits,
+            'fit_sample': self.fit_sample,
+            'sample_seed': self.sample_seed,
+            'minibatch': self.minibatch,
+            'init': self.init,
+            'warm_start': self.session is not None,
+            'algorithm_version': ALGORITHM_VERSION,
+        }
+
+    def _sample_rng(self, stage):
+        """Independent, reproducible generator for each pass."""
+        return np.random.default_rng([self.sample_seed, stage])
+
+    def _fit(self, name, fit, n_samples):
+        """
+        Fits `<name>_kmeans` through `fit(estimator) -> labels`, warm-started
+        from the session when there is one.
+        """
+        attr = f'{name}_kmeans'
+        if self.session is None:
+            return fit(getattr(self, attr))
+        estimator, labels = self.session.fit(name, getattr(self, attr), fit, n_samples)
+        setattr(self, attr, estimator)
+        return labels
 
     def _load_image(self):
         """Prepares grayscale image for the first segmentation pass."""
@@ -33,12 +182,41 @@ class Segmenter:
         Runs the first K-Means on the grayscale pixels.
         Returns the 2D label array and cluster centers.
         """
-        self.first_kmeans.fit(pixels)
-        labels = self.first_kmeans.labels_
+        # The histogram engine already covers every pixel at a fixed cost
+        if self.first_pass == 'kmeans' and self.fit_sample and self.fit_sample < self.img_gray.size:
+            return self._sampled_first_pass(pixels)
+
+        if self.first_pass == 'histogram':
+            lut, cluster_centers, self.first_counts = histogram_kmeans_1d(gray_histogram(pixels))
+            labels_2d = lut[pixels].reshape(self.img_gray.shape)
+            return labels_2d, cluster_centers
+
+        fit = lambda kmeans: fit_kmeans(kmeans, pixels, threads=self.threads).labels_
+        labels = self._fit('first', fit, len(pixels))
+        self.first_counts = np.bincount(labels, minlength=2)
         labels_2d = labels.reshape(self.img_gray.shape)
         cluster_centers = self.first_kmeans.cluster_centers_
         return labels_2d, cluster_centers
 
+    def _sampled_first_pass(self, pixels):
+        """Fits the first-pass centers on a subsample and labels every pixel through a LUT."""
+        rows, cols = stratified_sample(self.img_gray.shape, self.fit_sample, self._sample_rng(1))
+        sample = self.img_gray[rows, cols]
+
+        fit = lambda kmeans: fit_kmeans(kmeans, sample.reshape(-1, 1), threads=self.threads).labels_
+        self._fit('first', fit, sample.size)
+        cluster_centers = self.first_kmeans.cluster_centers_
+
+        levels = np.arange(GRAY_LEVELS, dtype=np.float32).reshape(-1, 1)
+        lut = assign_nearest(levels, cluster_centers)
+        self.first_counts = np.bincount(lut, weights=gray_histogram(pixels), minlength=2).astype(np.int64)
+        labels_2d = lut[self.img_gray]
+        return labels_2d, cluster_centers
+
+    def _select_material_cluster(self, cluster_centers):
+        """Picks the first-pass cluster that represents the material."""
+        return select_material_cluster(self.material_selection, cluster_centers, self.first_counts)
+
     def _plot_first_pass(
         self,
         segmented_image_material,
@@ -47,6 +225,8 @@ class Segmenter:
         background_percentage,
     ):
         """Plots results of the first segmentation."""
+        import matplotlib.pyplot as plt
+
         plt.figure(figsize=(12, 6))
 
         plt.subplot(1, 3, 1)
@@ -71,59 +251,117 @@ class Segmenter:
         plt.tight_layout()
         plt.show()
 
-    def _second_segmentation(self, segmented_image_material):
+    def _second_segmentation(self, material_mask):
+        """
+        Runs the second K-Means on the RGB values of the first-pass material
+        pixels selected by the boolean `material_mask`.
+        Returns the uint8 second-pass label of each of those pixels.
+        """
+        material_only_pixels = self.img_rgb[material_mask]
+        if len(material_only_pixels) < self.second_kmeans.n_clusters:
+            raise ValueError(
+                f"The first pass found {len(material_only_pixels)} material pixels, too few to "
+                f"segment (is the image uniform? try another material selection)"
+            )
+
+        if self.fit_sample and len(material_only_pixels) > self.fit_sample:
+            self._fit_second_pass(self._sample_material(material_only_pixels))
+            second_labels = assign_nearest(material_only_pixels, self.second_kmeans.cluster_centers_)
+        else:
+            second_labels = self._fit_second_pass(material_only_pixels)
 
-        flat_img = segmented_image_material.reshape((-1, 3))
-        non_black_mask = np.any(flat_img != [0, 0, 0], axis=1)
+        return second_labels.astype(np.uint8, copy=False)
 
-        material_only_pixels = flat_img[non_black_mask]
+    def _fit_second_pass(self, pixels):
+        """Fits second_kmeans on RGB pixels and returns their labels."""
+        if self.second_pass == 'unique':
+            fit = lambda kmeans: weighted_color_kmeans(kmeans, pixels, self.color_bits, self.threads)
+        else:
+            fit = lambda kmeans: fit_kmeans(kmeans, pixels, threads=self.threads).labels_
+        return self._fit('second', fit, len(pixels))
 
-        self.second_kmeans.fit(material_only_pixels)
-        second_labels = self.second_kmeans.labels_
+    def _sample_material(self, material_pixels):
+        """
+        Draws about `fit_sample` of the (N, 3) material pixels. Only the sample's
+        indices are allocated (a draw without replacement may permute all N);
+        the few duplicate draws are dropped, leaving the indices in raster order.
+        """
+        indices = self._sample_rng(2).integers(0, len(material_pixels), size=self.fit_sample)
+        return material_pixels[np.unique(indices)]
 
-        new_labels_full = np.zeros((len(flat_img),), dtype=np.int32)
-        new_labels_full[non_black_mask] = second_labels
+    def coverage_deviation(self, result=None):
+        """
+        Compares a subsample fit with the full fit on the same image.
 
-        new_labels_2d = new_labels_full.reshape(segmented_image_material.shape[:2])
-        return new_labels_2d
+        Args:
+            result: SegmentationResult of this segmenter (computed when None)
+
+        Returns:
+            Dict with both material percentages, their difference in percentage
+            points, and the fraction of pixels whose label agrees
+        """
+        if result is None:
+            result = self.segment()
+
+        full = Segmenter(
+            self.img_rgb,
+            material_selection=self.material_selection,
+            first_pass=self.first_pass,
+            second_pass=self.second_pass,
+            color_bits=self.color_bits,
+            minibatch=self.minibatch,
+            init=self.init,
+            threads=self.threads,
+            headless=True,
+        ).segment()
+
+        return {
+            'sampled_percentage': result.material_percentage,
+            'full_percentage': full.material_percentage,
+            'percentage_deviation': result.material_percentage - full.material_percentage,
+            'label_agreement': float(np.mean(result.label_map == full.label_map)),
+        }
+
+    def _output_path(self, save_dir, suffix):
+        os.makedirs(save_dir, exist_ok=True)
+        stem = os.path.splitext(os.path.basename(self.image_path))[0] if self.image_path else "image"
+        return os.path.join(save_dir, stem + suffix)
 
     def _save_image_(self, combined_background, material_percentage):
+        import matplotlib.pyplot as plt
+
         plt.imshow(combined_background)
         plt.title(f"Overlay: Material Al {material_percentage:.2f}%")
         plt.axis("off")
         plt.tight_layout()
 
-        save_dir = "Predictions"
-        if not os.path.exists(save_dir):
-            os.makedirs(save_dir, exist_ok=True)
-
-        filename = os.path.basename(self.image_path)[:-4] + "_percentage.png"
-        save_path = os.path.join(save_dir, filename)
+        save_path = self._output_path("Predictions", "_percentage.png")
 
         plt.savefig(save_path)
         print(f"Saved in {save_path}")
 
         plt.close()
 
+    def write_outputs(self, result, save_dir):
+        """
+        Writes the material mask and the overlay image of a headless run with
+        cv2.imencode. Returns the (mask_path, overlay_path) pair.
+        """
+        mask_path = self._output_path(save_dir, "_mask.png")
+        overlay_path = self._output_path(save_dir, "_overlay.png")
 
-    def _plot_second_pass(
-        self,
-        segmented_image_background_first,
-        segmented_image_background_second,
-    ):
-        def overlay_images(pass1_image, pass2_image):
-            combined = pass1_image.copy()
-            mask = np.any(pass2_image != [0, 0, 0], axis=-1)
-            combined[mask] = pass2_image[mask]
-            return combined
-
-        combined_background = overlay_images(
-            segmented_image_background_first, segmented_image_background_second
-        )
-        total_pixels = self.img_gray.size
-        mask_non_black = np.any(combined_background != [0, 0, 0], axis=-1)
-        material_pixels = np.count_nonzero(mask_non_black)
-        material_percentage = (material_pixels / total_pixels) * 100
+        ok_mask, mask_png = cv2.imencode(".png", (result.label_map == LABEL_MATERIAL).astype(np.uint8) * 255)
+        overlay_bgr = cv2.cvtColor(result.overlay(self.img_rgb), cv2.COLOR_RGB2BGR)
+        ok_overlay, overlay_png = cv2.imencode(".png", overlay_bgr)
+        if not (ok_mask and ok_overlay):
+            raise IOError("Could not encode segmentation outputs")
+
+        mask_png.tofile(mask_path)
+        overlay_png.tofile(overlay_path)
+        return mask_path, overlay_path
+
+    def _plot_second_pass(self, combined_background, material_percentage):
+        import matplotlib.pyplot as plt
 
         plt.figure(figsize=(16, 10))
 
@@ -142,54 +380,53 @@ class Segmenter:
         self._save_image_(combined_background=combined_background, 
                           material_percentage=material_percentage)
 
-    def __call__(self):
-        pixels = self._load_image()
-        label2d, cluster_centers = self._kmeans_first_pass(pixels)
-
-        # Select which cluster represents the material
-        if self.material_selection == 'auto':
-            # Use the smaller cluster (assumes material is minority)
-            cluster_0_count = np.sum(label2d == 0)
-            cluster_1_count = np.sum(label2d == 1)
-            material_cluster = 0 if cluster_0_count < cluster_1_count else 1
-        elif self.material_selection == 'bright':
-            # Use the brighter cluster
-            avg_intensity = cluster_centers.flatten()
-            material_cluster = np.argmax(avg_intensity)
-        elif self.material_selection == 'dark':
-            # Use the darker cluster
-            avg_intensity = cluster_centers.flatten()
-            material_cluster = np.argmin(avg_intensity)
-        else:
-            raise ValueError(f"Invalid material_selection: {self.material_selection}")
+    def segment(self):
+        """Runs both clustering passes and returns a SegmentationResult."""
+        with stage(self.profile, 'first_pass'):
+            pixels = self._load_image()
+            label2d, cluster_centers = self._kmeans_first_pass(pixels)
+            material_cluster = self._select_material_cluster(cluster_centers)
 
-        binary_mask = (label2d == material_cluster).astype(np.uint8)
+        with stage(self.profile, 'masks'):
+            material_mask = label2d == material_cluster
+            del label2d
 
-        segmented_image_material_first = self.img_rgb.copy()
-        segmented_image_background_first = self.img_rgb.copy()
+        with stage(self.profile, 'second_pass'):
+            second_labels = self._second_segmentation(material_mask)
 
-        # binary_mask == 1 means material (brighter cluster)
-        # binary_mask == 0 means background (darker cluster)
-        segmented_image_material_first[binary_mask == 0] = [0, 0, 0]  # Remove background pixels
-        segmented_image_background_first[binary_mask == 1] = [0, 0, 0]  # Remove material pixels
+            second_centers = self.second_kmeans.cluster_centers_
+            avg_color_intensity = np.sum(second_centers, axis=1)
+            material_cluster_2 = np.argmax(avg_color_intensity)
 
-        new_labels_2d = self._second_segmentation(segmented_image_material_first)
+        with stage(self.profile, 'masks'):
+            label_map = np.full(material_mask.shape, LABEL_BACKGROUND, dtype=np.uint8)
+            label_map[material_mask] = material_labels(second_labels, material_cluster_2)
+            del second_labels
 
-        second_centers = self.second_kmeans.cluster_centers_
+        # Calculate material percentage based on ALL material from first pass (not refined second pass)
+        total_pixels = self.img_gray.size
+        material_pixels = self.first_counts[material_cluster]
+        material_percentage = (material_pixels / total_pixels) * 100
 
-        avg_color_intensity = np.sum(second_centers, axis=1)
-        material_cluster_2 = np.argmax(avg_color_intensity)
+        return SegmentationResult(
+            label_map=label_map,
+            material_percentage=float(material_percentage),
+            first_centers=cluster_centers,
+            second_centers=second_centers,
+        )
 
-        segmented_image_material_second = segmented_image_material_first.copy()
-        segmented_image_background_second = segmented_image_material_first.copy()
+    def __call__(self):
+        result = self.segment()
 
-        material_mask_2 = new_labels_2d == material_cluster_2
-        segmented_image_material_second[~material_mask_2] = [0, 0, 0]
+        if self.headless:
+            if self.save_dir:
+                self.write_outputs(result, self.save_dir)
+            return result
 
-        segmented_image_background_second[material_mask_2] = [0, 0, 0]
+        # Plot view: first-pass background plus the material the second pass rejected
+        combined_background = self.img_rgb.copy()
+        combined_background[result.label_map == LABEL_MATERIAL] = 0
+        # A pixel is non-black when its brightest channel is
+        material_percentage = np.count_nonzero(combined_background.max(axis=2)) / self.img_gray.size * 100
 
-        self._plot_second_pass(
-            segmented_image_background_first=segmented_image_background_first,
-            segmented_image_background_second=segmented_image_background_second,
-        )
-        
+        self._plot_second_pass(combined_background, material_percentage)
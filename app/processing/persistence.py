@@ -0,0 +1,184 @@
+"""
+Output encoding and write-behind persistence.
+
+A result is encoded once (EncodedOutput) and the same bytes are shared by the
+saved file and the download button. Saving itself runs on a background thread
+fed by a bounded queue, so the request path only pays for the encoding.
+"""
+import os
+import queue
+import atexit
+import logging
+import threading
+import numpy as np
+
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+from config import AppConfig
+from .image_io import encode_mask_png
+from .labels import PackedLabels
+
+OUTPUT_FORMATS = ('png', 'webp', 'mask')
+
+
+@dataclass(frozen=True)
+class EncodedOutput:
+    """Encoded result image, ready to be written or downloaded."""
+    data: bytes
+    extension: str  # without the dot
+    mime: str
+    output_format: str
+
+
+def encode_output(result: np.ndarray, labels: Optional[PackedLabels] = None,
+                  output_format: Optional[str] = None,
+                  png_compression: Optional[int] = None) -> EncodedOutput:
+    """
+    Encodes a processed result.
+
+    Args:
+        result: (H, W, 3) uint8 RGB overlay returned by ImageProcessor
+        labels: Packed labels of the result, required by the 'mask' format
+        output_format: OUTPUT_FORMAT when None
+            - 'png': RGB overlay PNG
+            - 'webp': Lossless RGB overlay WebP (smaller, slower to encode)
+            - 'mask': 1-bit PNG of the first-pass material
+        png_compression: zlib level 0-9 of the RGB PNG (OUTPUT_PNG_COMPRESSION when
+                         None). Without a level OpenCV uses its speed-tuned settings
+                         (fast filter and level); any explicit level enables the
+                         adaptive filters, which are smaller and slower.
+    """
+    import cv2
+
+    output_format = output_format or AppConfig.get('OUTPUT_FORMAT')
+    if output_format == 'mask':
+        if labels is None:
+            raise ValueError("The 'mask' output format needs the packed labels")
+        return EncodedOutput(encode_mask_png(labels.material_mask()), "png", "image/png", output_format)
+
+    result_bgr = cv2.cvtColor(result, cv2.COLOR_RGB2BGR)
+    if output_format == 'png':
+        if png_compression is None:
+            png_compression = AppConfig.get('OUTPUT_PNG_COMPRESSION')
+        params = [] if png_compression is None else [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+        ok, buffer = cv2.imencode(".png", result_bgr, params)
+        mime = "image/png"
+    elif output_format == 'webp':
+        # Quality above 100 selects lossless WebP
+        ok, buffer = cv2.imencode(".webp", result_bgr, [cv2.IMWRITE_WEBP_QUALITY, 101])
+        mime = "image/webp"
+    else:
+        raise ValueError(f"Invalid output format: {output_format}")
+
+    if not ok:
+        raise ValueError(f"Could not encode the result as {output_format}")
+    return EncodedOutput(buffer.tobytes(), output_format, mime, output_format)
+
+
+class WriteBehindQueue:
+    """
+    Runs persistence jobs on one background thread.
+
+    The queue holds at most `max_pending` jobs; submitting to a full queue
+    blocks, so a slow disk slows the producers down instead of piling encoded
+    images up in memory. `flush` waits for the queued jobs, and `close` (also
+    registered at exit) flushes and stops the thread.
+
+    Jobs submitted with a key are tracked until they have run, so a second
+    write of the same thing can find the pending one (see `pending`) instead
+    of being queued again.
+    """
+
+    def __init__(self, max_pending: int = 4):
+        self._jobs: "queue.Queue[Optional[Tuple[Callable[[], Any], Future, Hashable]]]" = \
+            queue.Queue(maxsize=max_pending)
+        self._pending: Dict[Hashable, Tuple[Future, Any]] = {}
+        self._pending_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._closed = False
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            item = self._jobs.get()
+            try:
+                if item is None:
+                    return
+                job, future, key = item
+                try:
+                    future.set_result(job())
+                except Exception as e:
+                    logging.exception("Write-behind job failed")
+                    future.set_exception(e)
+                finally:
+                    if key is not None:
+                        with self._pending_lock:
+                            self._pending.pop(key, None)
+            finally:
+                self._jobs.task_done()
+
+    def submit(self, job: Callable[[], Any], key: Optional[Hashable] = None,
+               target: Any = None) -> Tuple[Future, Any]:
+        """
+        Queues `job`, waiting while the queue is full. Returns the job's future,
+        which holds its return value or exception, and its `target`.
+
+        Args:
+            key: Identifies what the job writes; while it is pending, a job
+                 submitted under the same key is not queued and the pending
+                 job's future is returned instead
+            target: What the job produces (e.g. the output path)
+        """
+        if self._closed:
+            raise RuntimeError("Write-behind queue is closed")
+        future = Future()
+        if key is not None:
+            with self._pending_lock:
+                if key in self._pending:
+                    return self._pending[key]
+                self._pending[key] = (future, target)
+        self._jobs.put((job, future, key))
+        return future, target
+
+    def pending(self, key: Hashable) -> Optional[Tuple[Future, Any]]:
+        """(future, target) of the job queued under `key` that has not run yet, or None."""
+        with self._pending_lock:
+            return self._pending.get(key)
+
+    def flush(self):
+        """Blocks until every queued job has run."""
+        self._jobs.join()
+
+    def close(self):
+        """Flushes the queue and stops the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._jobs.put(None)
+        self._thread.join()
+
+
+def write_file(path: str, data: bytes):
+    """Writes `data` to `path` atomically (readers never see a partial file)."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+_default_writer: Optional[WriteBehindQueue] = None
+_default_writer_lock = threading.Lock()
+
+
+def default_writer() -> Optional[WriteBehindQueue]:
+    """The process-wide write-behind queue (None when PERSIST_QUEUE_SIZE disables it)."""
+    global _default_writer
+    max_pending = AppConfig.get('PERSIST_QUEUE_SIZE')
+    if not max_pending:
+        return None
+    with _default_writer_lock:
+        if _default_writer is None:
+            _default_writer = WriteBehindQueue(max_pending)
+        return _default_writer
@@ -0,0 +1,85 @@
+import json
+import time
+import logging
+import threading
+import tracemalloc
+
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, List, Optional
+
+
+# tracemalloc is process-global: it is started once and never stopped, and only
+# one stage of the process at a time owns the peak counter (see StageProfiler)
+_tracing_lock = threading.Lock()
+_memory_stage = threading.Lock()
+
+
+def _ensure_tracing():
+    with _tracing_lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+
+class StageProfiler:
+    """
+    Records wall time and allocated bytes of the named stages of one run.
+
+    Memory is measured with tracemalloc, which also sees numpy buffers: for each
+    stage, `allocated_bytes` is the peak of new allocations above the level at
+    stage entry and `retained_bytes` what is still allocated when it ends.
+    Stages must not nest; a stage entered several times accumulates.
+
+    Tracing slows every allocation down, so memory is only tracked when asked
+    for. The counters are shared by the whole process: while a stage of another
+    profiler (e.g. another thread's ImageProcessor) is measuring, a stage only
+    records its time, and its byte counts stay None when never measured.
+    """
+
+    def __init__(self, track_memory: bool = False):
+        self.track_memory = track_memory
+        self.records: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        if track_memory:
+            _ensure_tracing()
+
+    @contextmanager
+    def stage(self, name: str):
+        measuring = self.track_memory and _memory_stage.acquire(blocking=False)
+        if measuring:
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            if measuring:
+                current, peak = tracemalloc.get_traced_memory()
+                _memory_stage.release()
+
+            record = self.records.setdefault(
+                name, {'stage': name, 'seconds': 0.0, 'allocated_bytes': None, 'retained_bytes': None}
+            )
+            record['seconds'] += seconds
+            if measuring:
+                record['allocated_bytes'] = max(record['allocated_bytes'] or 0, max(0, peak - base))
+                record['retained_bytes'] = (record['retained_bytes'] or 0) + current - base
+
+    def as_records(self) -> List[Dict[str, Any]]:
+        """Stage records in execution order, with rounded durations."""
+        return [dict(record, seconds=round(record['seconds'], 6)) for record in self.records.values()]
+
+    @property
+    def total_seconds(self) -> float:
+        return sum(record['seconds'] for record in self.records.values())
+
+    def log(self, logger: logging.Logger, **context):
+        """Writes the run as one JSON record so log files stay grep- and parse-friendly."""
+        payload = dict(context, total_seconds=round(self.total_seconds, 6), stages=self.as_records())
+        logger.info(f"Stage profile: {json.dumps(payload)}")
+
+
+def stage(profiler: Optional[StageProfiler], name: str):
+    """Context manager timing `name` on `profiler`, or doing nothing without one."""
+    return profiler.stage(name) if profiler is not None else nullcontext()
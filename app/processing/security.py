@@ -1,6 +1,7 @@
 import os
-import cv2
+import uuid
 import logging
+from typing import Optional
 from config import AppConfig
 from datetime import datetime
 
@@ -18,7 +19,35 @@ def validate_upload(uploaded_file) -> bool:
         raise ValueError("Unsupported file format")
         
     return True
-def save_segmented_image(result, uploaded_file_name, percentage: float) -> str:
+def save_segmented_image(result, uploaded_file_name, percentage: float,
+                         result_key: Optional[str] = None, store=None,
+                         encoded=None, writer=None) -> str:
+    """
+    Saves the segmented image and its percentage under SAVE_DIR.
+
+    With a ResultStore and the result's cache key, the run is added to the
+    store's history, and a result that was already saved (or is still queued
+    for saving) in the same output format is not written again: the path of
+    the existing file is returned instead.
+
+    Args:
+        encoded: EncodedOutput of `result` to write as is (encoded with the
+                 configured OUTPUT_FORMAT when None)
+        writer: WriteBehindQueue that writes the files in the background; the
+                returned path only exists once the queue has run the job, and
+                write errors are logged by the queue
+    """
+    from .persistence import encode_output, write_file
+
+    output_format = encoded.output_format if encoded is not None else AppConfig.get('OUTPUT_FORMAT')
+    dedup_key = ('output', result_key, output_format) if store is not None and result_key else None
+
+    if dedup_key is not None:
+        pending = writer.pending(dedup_key) if writer is not None else None
+        existing = pending[1] if pending else store.saved_path(result_key, output_format)
+        if existing:
+            store.record_run(result_key, uploaded_file_name, existing, output_format)
+            return existing
 
     save_path = AppConfig.get('SAVE_DIR')
     os.makedirs(save_path, exist_ok=True)
@@ -26,16 +55,30 @@ def save_segmented_image(result, uploaded_file_name, percentage: float) -> str:
     timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     safe_uploaded_filename = uploaded_file_name.replace(" ", "_").replace("/", "_")
 
-    image_filename = f"segmented_{safe_uploaded_filename}_{timestamp}.png"
-    text_filename = f"segmented_{safe_uploaded_filename}_{timestamp}.txt"
+    if encoded is None:
+        encoded = encode_output(result)
+
+    # Uploads sharing a name, or formats sharing an extension, may be saved within
+    # the same second: a random suffix keeps their files apart
+    stem = f"segmented_{safe_uploaded_filename}_{timestamp}_{output_format}_{uuid.uuid4().hex[:8]}"
+    image_filename = f"{stem}.{encoded.extension}"
+    text_filename = f"{stem}.txt"
 
     image_save_path = os.path.join(save_path, image_filename)
     text_save_path = os.path.join(save_path, text_filename)
 
-    result_bgr = cv2.cvtColor(result, cv2.COLOR_RGB2BGR)
-    cv2.imwrite(image_save_path, result_bgr)
+    def persist():
+        write_file(image_save_path, encoded.data)
+        write_file(text_save_path, f"Percentage: {percentage:.2f}%".encode())
+        if dedup_key is not None:
+            store.record_run(result_key, uploaded_file_name, image_save_path, output_format)
+        return image_save_path
 
-    with open(text_save_path, "w") as f:
-        f.write(f"Percentage: {percentage:.2f}%")
+    if writer is None:
+        return persist()
 
-    return image_save_path
\ No newline at end of file
+    _, queued_path = writer.submit(persist, key=dedup_key, target=image_save_path)
+    if queued_path != image_save_path:
+        # Another thread queued the same result in the meantime
+        store.record_run(result_key, uploaded_file_name, queued_path, output_format)
+    return queued_path
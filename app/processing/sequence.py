@@ -0,0 +1,325 @@
+"""
+Frame-sequence segmentation for in-situ videos and image stacks.
+
+Run from the `app` directory:
+    python -m processing.sequence anneal.mp4 --masks anneal_masks.npz --coverage anneal.csv
+"""
+import os
+import csv
+import cv2
+import glob
+import zipfile
+import argparse
+import numpy as np
+
+from dataclasses import dataclass
+from typing import Iterable, Iterator, List, Optional, Tuple
+from sklearn.cluster import KMeans
+
+from .image_io import IMAGE_EXTENSIONS, decode_image
+from .clustering import SEEDED_INIT, gray_histogram, histogram_kmeans_1d, weighted_color_kmeans
+from .model import label_pixels, select_material_cluster
+from .session import ClusteringSession
+
+STACK_EXTENSIONS = ('.tif', '.tiff')
+
+
+@dataclass
+class FrameResult:
+    """Segmentation of one frame of a sequence."""
+    index: int
+    time_s: Optional[float]     # Timestamp from the container or index / fps
+    label_map: np.ndarray       # (H, W) uint8 with LABEL_* values
+    material_percentage: float  # First-pass material share of the frame
+    refit: bool                 # True when the model was fitted on this frame
+    recomputed_fraction: float  # Share of pixels labelled anew
+
+
+def iter_frames(source, fps: Optional[float] = None) -> Iterator[Tuple[Optional[float], np.ndarray]]:
+    """
+    Streams (time_s, rgb_frame) pairs from a video file, a multi-page TIFF, a
+    `.npy` stack, a directory or glob of images, a (T, H, W[, 3]) array, or any
+    iterable of frames. Timestamps are index / fps, with the container's frame
+    rate for videos; they are None for other sources when `fps` is not given.
+    """
+    def timestamp(index):
+        return index / fps if fps else None
+
+    if isinstance(source, (str, os.PathLike)):
+        path = str(source)
+        lower = path.lower()
+        if os.path.isdir(path) or glob.has_magic(path):
+            pattern = os.path.join(path, "*.*") if os.path.isdir(path) else path
+            files = sorted(f for f in glob.glob(pattern) if f.lower().endswith(IMAGE_EXTENSIONS))
+            for index, file in enumerate(files):
+                yield timestamp(index), decode_image(file)[0]
+            return
+        if lower.endswith(".npy"):
+            source = np.load(path, mmap_mode="r")
+        elif lower.endswith(STACK_EXTENSIONS):
+            yield from _iter_stack(path, timestamp)
+            return
+        else:
+            yield from _iter_video(path, fps)
+            return
+
+    for index, frame in enumerate(source):
+        yield timestamp(index), decode_image(np.ascontiguousarray(frame))[0]
+
+
+def _iter_stack(path: str, timestamp) -> Iterator[Tuple[Optional[float], np.ndarray]]:
+    """Decodes a multi-page image one page at a time instead of the whole stack at once."""
+    count = cv2.imcount(path)
+    if count <= 0:
+        raise ValueError(f"Could not read image stack: {path}")
+    for index in range(count):
+        ok, pages = cv2.imreadmulti(path, index, 1, flags=cv2.IMREAD_COLOR)
+        if not ok or not pages:
+            raise ValueError(f"Could not read page {index} of image stack: {path}")
+        yield timestamp(index), cv2.cvtColor(pages[0], cv2.COLOR_BGR2RGB)
+
+
+def _iter_video(path: str, fps: Optional[float]) -> Iterator[Tuple[Optional[float], np.ndarray]]:
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video: {path}")
+    fps = fps or capture.get(cv2.CAP_PROP_FPS) or None
+    try:
+        index = 0
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            time_s = index / fps if fps else capture.get(cv2.CAP_PROP_POS_MSEC) / 1000
+            yield time_s, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            index += 1
+    finally:
+        capture.release()
+
+
+class SequenceSegmenter:
+    def __init__(self, material_selection='auto', color_bits=8, center_tolerance=2.0,
+                 pixel_tolerance=6, block_size=32, refresh_interval=None, session=None):
+        """
+        Segments consecutive frames, reusing the previous frame's model and labels.
+
+        The exact histogram 2-means runs on every frame, which is cheap. A frame is
+        fitted from scratch, with the second pass warm-started from the previous
+        centers, when its first-pass centers moved more than `center_tolerance`
+        from those of the last fitted frame. Otherwise the fitted model is kept,
+        and only blocks with a pixel that changed by more than `pixel_tolerance`
+        since it was last labelled are recomputed.
+
+        Args:
+            material_selection: 'auto', 'bright' or 'dark' (see Segmenter)
+            color_bits: Bits per channel used when fitting the second pass
+            center_tolerance: First-pass center shift (gray levels) that triggers a refit
+            pixel_tolerance: Per-channel change below which a pixel keeps its label
+            block_size: Edge length of the blocks recomputed as a whole
+            refresh_interval: Refit at least every this many frames (None = never forced)
+            session: ClusteringSession used for the second-pass fits
+        """
+        self.material_selection = material_selection
+        self.color_bits = color_bits
+        self.center_tolerance = center_tolerance
+        self.pixel_tolerance = pixel_tolerance
+        self.block_size = block_size
+        self.refresh_interval = refresh_interval
+        self.session = session if session is not None else ClusteringSession()
+        self.reset()
+
+    def reset(self):
+        """Drops the frame state; the next frame is fitted from scratch."""
+        self._model = None
+        self._fit_centers = None
+        self._fit_index = None
+        self._reference = None
+        self._labels = None
+
+    def _fit(self, rgb: np.ndarray, gray: np.ndarray, first_pass):
+        lut, first_centers, counts = first_pass
+        material_lut = lut == select_material_cluster(self.material_selection, first_centers, counts)
+
+        material_pixels = rgb[material_lut[gray]]
+        if len(material_pixels) < 2:
+            raise ValueError("Not enough material pixels to fit the second pass")
+        second_kmeans, _ = self.session.fit(
+            'second',
+            KMeans(n_clusters=2, init=SEEDED_INIT, n_init=1, random_state=42),
+            lambda kmeans: weighted_color_kmeans(kmeans, material_pixels, self.color_bits),
+            len(material_pixels),
+        )
+        second_centers = second_kmeans.cluster_centers_
+        self._model = (material_lut, second_centers, int(np.argmax(second_centers.sum(axis=1))))
+        self._fit_centers = first_centers
+
+    def _changed_region(self, rgb: np.ndarray):
+        """
+        Finds the blocks holding a pixel that moved beyond the tolerance.
+
+        Returns:
+            (window, mask): slices bounding the changed blocks and the boolean
+            block mask inside that window, or None when nothing changed
+        """
+        tolerance = (self.pixel_tolerance,) * 3
+        moved = cv2.inRange(cv2.absdiff(rgb, self._reference), (0, 0, 0), tolerance) == 0
+        height, width = moved.shape
+        bs = self.block_size
+        grid_h, grid_w = -(-height // bs), -(-width // bs)
+
+        padded = np.zeros((grid_h * bs, grid_w * bs), dtype=bool)
+        padded[:height, :width] = moved
+        blocks = padded.reshape(grid_h, bs, grid_w, bs).any(axis=(1, 3))
+        if not blocks.any():
+            return None
+
+        block_rows = np.flatnonzero(blocks.any(axis=1))
+        block_cols = np.flatnonzero(blocks.any(axis=0))
+        rows = slice(block_rows[0] * bs, min((block_rows[-1] + 1) * bs, height))
+        cols = slice(block_cols[0] * bs, min((block_cols[-1] + 1) * bs, width))
+
+        window_blocks = blocks[block_rows[0]:block_rows[-1] + 1, block_cols[0]:block_cols[-1] + 1]
+        mask = np.repeat(np.repeat(window_blocks, bs, axis=0), bs, axis=1)
+        return (rows, cols), mask[:rows.stop - rows.start, :cols.stop - cols.start]
+
+    def process(self, index: int, time_s: Optional[float], rgb: np.ndarray) -> FrameResult:
+        """Segments one frame given in acquisition order."""
+        gray = cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY)
+        first_pass = histogram_kmeans_1d(gray_histogram(gray))
+
+        refit = (
+            self._model is None
+            or self._labels.shape != gray.shape
+            or np.abs(first_pass[1] - self._fit_centers).max() > self.center_tolerance
+            or (self.refresh_interval and index - self._fit_index >= self.refresh_interval)
+        )
+
+        if refit:
+            self._fit(rgb, gray, first_pass)
+            self._fit_index = index
+            self._labels = label_pixels(rgb, gray, *self._model)
+            self._reference = rgb.copy()
+            recomputed = gray.size
+        else:
+            recomputed = 0
+            region = self._changed_region(rgb)
+            if region is not None:
+                # Views of the state: the assignments below update it in place
+                window, changed = region
+                labels, reference = self._labels[window], self._reference[window]
+                window_rgb, window_gray = rgb[window], gray[window]
+
+                labels[changed] = label_pixels(window_rgb[changed], window_gray[changed], *self._model)
+                reference[changed] = window_rgb[changed]
+                recomputed = int(np.count_nonzero(changed))
+
+        # LABEL_BACKGROUND is 0, so every non-zero label is first-pass material
+        material_pixels = cv2.countNonZero(self._labels)
+        return FrameResult(
+            index=index,
+            time_s=time_s,
+            label_map=self._labels.copy(),
+            material_percentage=float(material_pixels / gray.size * 100),
+            refit=bool(refit),
+            recomputed_fraction=recomputed / gray.size,
+        )
+
+    def __call__(self, frames: Iterable[Tuple[Optional[float], np.ndarray]]) -> Iterator[FrameResult]:
+        """Lazily segments (time_s, rgb_frame) pairs, e.g. from iter_frames."""
+        for index, (time_s, rgb) in enumerate(frames):
+            yield self.process(index, time_s, rgb)
+
+
+class MaskStackWriter:
+    """
+    Streams label maps into a compressed `.npz` archive, one `frame_NNNNNN`
+    member per frame, so the stack never has to fit in memory. The result
+    loads lazily with np.load.
+    """
+
+    def __init__(self, path: str):
+        self._zip = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED)
+
+    def write(self, index: int, label_map: np.ndarray):
+        with self._zip.open(f"frame_{index:06d}.npy", "w", force_zip64=True) as member:
+            np.lib.format.write_array(member, np.ascontiguousarray(label_map), allow_pickle=False)
+
+    def close(self):
+        self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+COVERAGE_FIELDS = ["frame", "time_s", "material_percentage", "refit", "recomputed_fraction"]
+
+
+def segment_sequence(source, masks_path: Optional[str] = None, coverage_path: Optional[str] = None,
+                     fps: Optional[float] = None, **kwargs) -> List[dict]:
+    """
+    Segments a whole sequence and returns its coverage-vs-time series.
+
+    Args:
+        source: Anything accepted by iter_frames
+        masks_path: Optional `.npz` receiving the compressed label-map stack
+        coverage_path: Optional CSV receiving the coverage series
+        fps: Frame rate used for timestamps of sources without their own
+        **kwargs: SequenceSegmenter options
+    """
+    segmenter = SequenceSegmenter(**kwargs)
+    writer = MaskStackWriter(masks_path) if masks_path else None
+    series = []
+    try:
+        for frame in segmenter(iter_frames(source, fps=fps)):
+            if writer:
+                writer.write(frame.index, frame.label_map)
+            series.append({
+                "frame": frame.index,
+                "time_s": frame.time_s,
+                "material_percentage": round(frame.material_percentage, 4),
+                "refit": frame.refit,
+                "recomputed_fraction": round(frame.recomputed_fraction, 4),
+            })
+    finally:
+        if writer:
+            writer.close()
+
+    if coverage_path:
+        with open(coverage_path, "w", newline="") as f:
+            csv_writer = csv.DictWriter(f, fieldnames=COVERAGE_FIELDS)
+            csv_writer.writeheader()
+            csv_writer.writerows(series)
+    return series
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Segment every frame of a video or image stack.")
+    parser.add_argument("source", help="Video file, multi-page TIFF, .npy stack, or directory/glob of images.")
+    parser.add_argument("--masks", type=str, default=None, help="Compressed .npz label-map stack to write.")
+    parser.add_argument("--coverage", type=str, default="coverage.csv", help="Coverage-vs-time CSV to write.")
+    parser.add_argument("--fps", type=float, default=None, help="Frame rate for sources without timestamps.")
+    parser.add_argument("--material_selection", type=str, default="auto", choices=["auto", "bright", "dark"])
+    parser.add_argument("--center_tolerance", type=float, default=2.0)
+    parser.add_argument("--pixel_tolerance", type=int, default=6)
+    parser.add_argument("--refresh_interval", type=int, default=None)
+    args = parser.parse_args()
+
+    series = segment_sequence(
+        args.source,
+        masks_path=args.masks,
+        coverage_path=args.coverage,
+        fps=args.fps,
+        material_selection=args.material_selection,
+        center_tolerance=args.center_tolerance,
+        pixel_tolerance=args.pixel_tolerance,
+        refresh_interval=args.refresh_interval,
+    )
+    refits = sum(record["refit"] for record in series)
+    print(f"Segmented {len(series)} frames ({refits} refits); coverage saved in {args.coverage}")
+
+
+if __name__ == "__main__":
+    main()
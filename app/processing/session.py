@@ -0,0 +1,102 @@
+import logging
+import threading
+import numpy as np
+
+from typing import Callable, Dict, Optional
+
+
+class ClusteringSession:
+    """
+    Carries fitted K-Means centers from one image to the next.
+
+    Images of one acquisition session have nearly identical cluster centers, so
+    once a pass has been fitted cold, later images start a single
+    Lloyd run from the previous centers. The warm fit is kept unless its centers
+    drift more than `max_drift` (in 0-255 intensity units) from the previous ones
+    or its inertia per pixel exceeds `max_inertia_ratio` times the session's
+    running reference, in which case the pass is refitted cold.
+
+    A session may be shared by threads (e.g. a background refinement and the
+    next upload of the same browser session): each fit runs from a snapshot of
+    the session model, and only reading and updating the model is locked.
+    """
+
+    def __init__(self, max_drift: float = 12.0, max_inertia_ratio: float = 1.5,
+                 smoothing: float = 0.5):
+        """
+        Args:
+            max_drift: Largest accepted center displacement between two images
+            max_inertia_ratio: Largest accepted inertia per pixel relative to the reference
+            smoothing: Weight of the newest image in the running inertia reference
+        """
+        self.max_drift = max_drift
+        self.max_inertia_ratio = max_inertia_ratio
+        self.smoothing = smoothing
+
+        self.centers: Dict[str, np.ndarray] = {}
+        self.inertia: Dict[str, float] = {}
+        self.warm_fits = 0
+        self.cold_fits = 0
+        self._lock = threading.Lock()
+
+    def fit(self, name: str, estimator, fit: Callable, n_samples: int):
+        """
+        Fits the pass `name`, warm-started from the session when possible.
+
+        Args:
+            name: Pass identifier, e.g. 'first' or 'second'
+            estimator: Cold (seeded or multi-restart) estimator used when no warm fit is accepted
+            fit: Callable fitting a given estimator and returning the pixel labels
+            n_samples: Number of pixels represented by the fit, used to normalize inertia
+
+        Returns:
+            (fitted_estimator, labels)
+        """
+        with self._lock:
+            previous = self.centers.get(name)
+            reference = self.inertia.get(name)
+        if previous is not None and len(previous) == estimator.n_clusters:
+            from sklearn.base import clone
+
+            warm = clone(estimator).set_params(init=previous, n_init=1)
+            labels = fit(warm)
+            reason = self._rejection(warm, previous, reference, n_samples)
+            if reason is None:
+                with self._lock:
+                    self._update(name, warm, n_samples)
+                    self.warm_fits += 1
+                return warm, labels
+            logging.info(f"Warm start of the {name} pass rejected ({reason}); refitting")
+
+        labels = fit(estimator)
+        with self._lock:
+            self._update(name, estimator, n_samples, reset=True)
+            self.cold_fits += 1
+        return estimator, labels
+
+    def _rejection(self, estimator, previous: np.ndarray, reference: Optional[float],
+                   n_samples: int) -> Optional[str]:
+        """Returns why a warm fit is not trusted, or None to accept it."""
+        # init=previous keeps the cluster order, so centers are compared index by index
+        drift = float(np.linalg.norm(estimator.cluster_centers_ - previous, axis=1).max())
+        if drift > self.max_drift:
+            return f"center drift {drift:.1f}"
+
+        inertia = estimator.inertia_ / max(n_samples, 1)
+        if reference and inertia > self.max_inertia_ratio * reference:
+            return f"inertia {inertia:.1f} vs {reference:.1f} per pixel"
+        return None
+
+    def _update(self, name: str, estimator, n_samples: int, reset: bool = False):
+        self.centers[name] = np.array(estimator.cluster_centers_, copy=True)
+        inertia = estimator.inertia_ / max(n_samples, 1)
+        if reset or name not in self.inertia:
+            self.inertia[name] = inertia
+        else:
+            self.inertia[name] += self.smoothing * (inertia - self.inertia[name])
+
+    def reset(self):
+        """Forgets the session model; the next image is fitted cold."""
+        with self._lock:
+            self.centers.clear()
+            self.inertia.clear()
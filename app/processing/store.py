@@ -0,0 +1,179 @@
+import os
+import json
+import sqlite3
+import threading
+
+from contextlib import closing
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from config import AppConfig
+from .labels import PackedLabels
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    image_hash TEXT NOT NULL,
+    params TEXT NOT NULL,
+    algorithm_version INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    material_percentage REAL NOT NULL,
+    mask_path TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_image_hash ON results (image_hash);
+
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL REFERENCES results (key),
+    file_name TEXT NOT NULL,
+    saved_path TEXT,
+    output_format TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_key ON runs (key);
+CREATE INDEX IF NOT EXISTS runs_file_name ON runs (file_name, created_at);
+"""
+
+
+class ResultStore:
+    """
+    Persistent segmentation results: an SQLite index keyed by the cache key
+    (image hash + parameters + algorithm version) pointing to bit-packed label
+    maps stored as .npz files, plus a history of analysis runs.
+
+    Every call opens its own connection, so one store can be shared by threads
+    and by worker processes; WAL mode lets readers proceed during writes.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.db_path = os.path.join(root, "index.sqlite")
+        os.makedirs(os.path.join(root, "masks"), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            # Stores created before runs recorded their output format
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(runs)")}
+            if "output_format" not in columns:
+                conn.execute("ALTER TABLE runs ADD COLUMN output_format TEXT")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _mask_path(self, key: str) -> str:
+        return os.path.join(self.root, "masks", key[:2], f"{key}.npz")
+
+    def get(self, key: str) -> Optional[Tuple[PackedLabels, float]]:
+        """Returns the stored (labels, material_percentage), or None."""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT mask_path, material_percentage FROM results WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+
+        path = os.path.join(self.root, row["mask_path"])
+        try:
+            labels = PackedLabels.load(path)
+        except (OSError, ValueError, KeyError):
+            # The mask file was removed or is unreadable: treat as a miss
+            return None
+        return labels, row["material_percentage"]
+
+    def contains(self, key: str) -> bool:
+        """True when a result is indexed under `key` (its mask file is not checked)."""
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT 1 FROM results WHERE key = ?", (key,)).fetchone() is not None
+
+    def put(self, key: str, image_hash: str, params: Dict[str, Any],
+            labels: PackedLabels, material_percentage: float):
+        """Stores packed labels (written atomically) and indexes them."""
+        path = self._mask_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        labels.save(tmp_path)
+        os.replace(tmp_path, path)
+
+        height, width = labels.shape
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key, image_hash, json.dumps(params, sort_keys=True),
+                    params.get('algorithm_version', 0), width, height, float(material_percentage),
+                    os.path.relpath(path, self.root), datetime.now().isoformat(timespec="seconds"),
+                ),
+            )
+
+    def record_run(self, key: str, file_name: str, saved_path: Optional[str] = None,
+                   output_format: Optional[str] = None):
+        """Appends an analysis of `file_name` to the history."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO runs (key, file_name, saved_path, output_format, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, file_name, saved_path, output_format, datetime.now().isoformat(timespec="seconds")),
+            )
+
+    def saved_path(self, key: str, output_format: Optional[str] = None) -> Optional[str]:
+        """Latest saved output of a result (in `output_format`) that still exists on disk, if any."""
+        query = "SELECT saved_path FROM runs WHERE key = ? AND saved_path IS NOT NULL"
+        args = [key]
+        if output_format is not None:
+            query += " AND output_format = ?"
+            args.append(output_format)
+        with closing(self._connect()) as conn:
+            rows = conn.execute(query + " ORDER BY id DESC", args).fetchall()
+        return next((row["saved_path"] for row in rows if os.path.exists(row["saved_path"])), None)
+
+    def history(self, file_name: Optional[str] = None, image_hash: Optional[str] = None,
+                since: Optional[str] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Coverage history, newest first.
+
+        Args:
+            file_name: Only runs of this uploaded file name
+            image_hash: Only runs of this image content
+            since: ISO timestamp; only runs at or after it
+            limit: Maximum number of rows
+        """
+        query = (
+            "SELECT runs.created_at, runs.file_name, runs.saved_path, results.image_hash, "
+            "results.material_percentage, results.params, results.width, results.height "
+            "FROM runs JOIN results ON results.key = runs.key"
+        )
+        conditions, args = [], []
+        for column, value in (("runs.file_name = ?", file_name), ("results.image_hash = ?", image_hash),
+                              ("runs.created_at >= ?", since)):
+            if value is not None:
+                conditions.append(column)
+                args.append(value)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY runs.id DESC"
+        if limit:
+            query += " LIMIT ?"
+            args.append(limit)
+
+        with closing(self._connect()) as conn:
+            rows = conn.execute(query, args).fetchall()
+        return [dict(row, params=json.loads(row["params"])) for row in rows]
+
+
+_default_store: Optional[ResultStore] = None
+_default_store_lock = threading.Lock()
+
+
+def default_store() -> Optional[ResultStore]:
+    """The store under RESULT_STORE_DIR, opened on first use (None when disabled)."""
+    global _default_store
+    root = AppConfig.get('RESULT_STORE_DIR')
+    if not root:
+        return None
+    with _default_store_lock:
+        if _default_store is None or _default_store.root != root:
+            _default_store = ResultStore(root)
+        return _default_store
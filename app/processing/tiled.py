@@ -0,0 +1,160 @@
+import os
+import cv2
+import logging
+import numpy as np
+
+from typing import Iterator, Optional, Tuple
+from sklearn.cluster import KMeans
+
+from .image_io import decode_image
+from .clustering import GRAY_LEVELS, SEEDED_INIT, histogram_kmeans_1d, weighted_color_kmeans
+from .model import (
+    LABEL_BACKGROUND, LABEL_MATERIAL, LABEL_REJECTED,
+    SegmentationResult, label_pixels, select_material_cluster,
+)
+
+
+def iter_tiles(height: int, width: int, tile_size: int) -> Iterator[Tuple[slice, slice]]:
+    """Yields (rows, cols) slices covering the image in row-major tile order."""
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            yield slice(y, min(y + tile_size, height)), slice(x, min(x + tile_size, width))
+
+
+def open_tiled_source(source):
+    """
+    Returns an array-like (H, W, 3) or (H, W) uint8 source that can be sliced tile by tile.
+
+    Arrays and np.memmap objects are used as is, `.npy` files are memory-mapped.
+    Any other object exposing `shape` and slice indexing (for example a zarr view
+    of a tiled TIFF) is accepted too. Other image files cannot be decoded in
+    chunks and are decoded whole.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        if str(source).lower().endswith(".npy"):
+            return np.load(source, mmap_mode="r")
+        logging.warning(f"{source} cannot be read in tiles; decoding the full image")
+        return decode_image(source)[0]
+
+    if not hasattr(source, "shape") or not hasattr(source, "__getitem__"):
+        raise ValueError("Tiled source must be a path or an array-like object")
+    return source
+
+
+class TiledSegmenter:
+    def __init__(self, source, material_selection='auto', tile_size=2048,
+                 sample_size=500_000, seed=42, color_bits=8):
+        """
+        Out-of-core two-pass segmentation whose memory depends on the tile size,
+        not on the image size.
+
+        Args:
+            source: Path to a `.npy` file, an np.memmap/ndarray, or another
+                    sliceable (H, W, 3) RGB / (H, W) grayscale uint8 source
+            material_selection: 'auto', 'bright' or 'dark' (see Segmenter)
+            tile_size: Edge length of the square tiles read at a time
+            sample_size: Pixels drawn across all tiles to fit the second pass
+            seed: Seed of the sampling generator
+            color_bits: Bits per channel used when fitting the second pass
+        """
+        self.source = open_tiled_source(source)
+        if len(self.source.shape) not in (2, 3):
+            raise ValueError(f"Unsupported image shape: {self.source.shape}")
+
+        self.height, self.width = self.source.shape[:2]
+        self.material_selection = material_selection
+        self.tile_size = tile_size
+        self.sample_size = sample_size
+        self.seed = seed
+        self.color_bits = color_bits
+
+        self.second_kmeans = KMeans(n_clusters=2, init=SEEDED_INIT, n_init=1, random_state=42)
+        self.label_counts = None
+
+    def _read_tile(self, rows: slice, cols: slice) -> Tuple[np.ndarray, np.ndarray]:
+        """Reads one tile and returns its RGB and grayscale versions."""
+        tile = np.ascontiguousarray(self.source[rows, cols])
+        if tile.ndim == 2:
+            return cv2.cvtColor(tile, cv2.COLOR_GRAY2RGB), tile
+        return tile, cv2.cvtColor(tile, cv2.COLOR_RGB2GRAY)
+
+    def _scan(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        First sweep: accumulates the exact grayscale histogram and draws a
+        pixel sample spread over the tiles in proportion to their area.
+        """
+        rng = np.random.default_rng(self.seed)
+        total_pixels = self.height * self.width
+        hist = np.zeros(GRAY_LEVELS, dtype=np.int64)
+        samples = []
+
+        for rows, cols in iter_tiles(self.height, self.width, self.tile_size):
+            tile_rgb, tile_gray = self._read_tile(rows, cols)
+            hist += np.bincount(tile_gray.ravel(), minlength=GRAY_LEVELS)
+
+            tile_pixels = tile_gray.size
+            k = min(tile_pixels, int(np.ceil(self.sample_size * tile_pixels / total_pixels)))
+            picked = rng.choice(tile_pixels, size=k, replace=False)
+            samples.append(tile_rgb.reshape(-1, 3)[picked])
+
+        return hist, np.concatenate(samples)
+
+    def __call__(self, output_path: Optional[str] = None) -> SegmentationResult:
+        """
+        Segments the source tile by tile.
+
+        Args:
+            output_path: `.npy` file receiving the uint8 label map through a
+                         memory map; the label map is kept in memory when None
+
+        Returns:
+            SegmentationResult whose label_map is the (memory-mapped) label map
+        """
+        hist, sample = self._scan()
+
+        lut, first_centers, first_counts = histogram_kmeans_1d(hist)
+        material_cluster = select_material_cluster(self.material_selection, first_centers, first_counts)
+        material_lut = lut == material_cluster
+
+        # Fit the second pass on the sampled pixels that fall into the material cluster
+        sample_gray = cv2.cvtColor(sample[np.newaxis], cv2.COLOR_RGB2GRAY)[0]
+        material_sample = sample[material_lut[sample_gray]]
+        if len(material_sample) < 2:
+            raise ValueError("Not enough material pixels in the sample to fit the second pass")
+        weighted_color_kmeans(self.second_kmeans, material_sample, self.color_bits)
+        second_centers = self.second_kmeans.cluster_centers_
+        material_cluster_2 = int(np.argmax(second_centers.sum(axis=1)))
+
+        if output_path:
+            label_map = np.lib.format.open_memmap(
+                output_path, mode="w+", dtype=np.uint8, shape=(self.height, self.width)
+            )
+        else:
+            label_map = np.empty((self.height, self.width), dtype=np.uint8)
+
+        # Second sweep: label every tile against the fitted centers
+        counts = np.zeros(3, dtype=np.int64)
+        for rows, cols in iter_tiles(self.height, self.width, self.tile_size):
+            tile_rgb, tile_gray = self._read_tile(rows, cols)
+            tile_labels = label_pixels(tile_rgb, tile_gray, material_lut, second_centers, material_cluster_2)
+
+            label_map[rows, cols] = tile_labels
+            counts += np.bincount(tile_labels.ravel(), minlength=3)
+
+        if isinstance(label_map, np.memmap):
+            label_map.flush()
+
+        self.label_counts = {
+            'background': int(counts[LABEL_BACKGROUND]),
+            'material': int(counts[LABEL_MATERIAL]),
+            'rejected': int(counts[LABEL_REJECTED]),
+        }
+        material_pixels = counts[LABEL_MATERIAL] + counts[LABEL_REJECTED]
+        material_percentage = material_pixels / (self.height * self.width) * 100
+
+        return SegmentationResult(
+            label_map=label_map,
+            material_percentage=float(material_percentage),
+            first_centers=first_centers,
+            second_centers=second_centers,
+        )
@@ -0,0 +1,168 @@
+"""
+HTTP segmentation service for programmatic clients (e.g. LIMS integrations).
+
+Run with:
+    uvicorn service:app --app-dir app --loop uvloop
+"""
+import os
+import base64
+import asyncio
+import logging
+
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+from typing import List
+
+from fastapi import FastAPI, File, Form, HTTPException, Query, UploadFile
+from fastapi.responses import Response
+
+from config import AppConfig
+from processing.security import validate_upload
+
+logger = logging.getLogger(__name__)
+
+MATERIAL_SELECTIONS = ("auto", "bright", "dark")
+
+
+def _limit_worker_threads(threads_per_worker: int):
+    """Pool initializer: caps BLAS/OpenMP, OpenCV and K-Means restart threads inside each worker."""
+    import cv2
+    from threadpoolctl import threadpool_limits
+
+    threadpool_limits(limits=threads_per_worker)
+    cv2.setNumThreads(threads_per_worker)
+    # Process-local: concurrent K-Means restarts share the worker's budget
+    AppConfig.DEFAULTS['KMEANS_THREADS'] = threads_per_worker
+
+
+def _segment_payload(data: bytes, material_selection: str) -> dict:
+    """Runs in a worker process: segments encoded image bytes into a compact payload."""
+    from processing.image_io import encode_mask_png
+    from processing.image_processor import ImageProcessor
+    from processing.store import default_store
+
+    processor = ImageProcessor(data, material_selection=material_selection, store=default_store())
+    labels, percentage = processor.segment_packed()
+    height, width = labels.shape
+    return {
+        "material_percentage": round(float(percentage), 4),
+        "width": width,
+        "height": height,
+        "mask_png": encode_mask_png(labels.material_mask()),
+    }
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    workers = AppConfig.get('API_WORKERS') or os.cpu_count() or 1
+    app.state.pool = ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_limit_worker_threads,
+        initargs=(AppConfig.get('API_THREADS_PER_WORKER'),),
+    )
+    # Bounds the number of images queued on the pool at once
+    app.state.slots = asyncio.Semaphore(AppConfig.get('API_MAX_PENDING'))
+    logger.info(f"Segmentation service started with {workers} workers")
+    try:
+        yield
+    finally:
+        app.state.pool.shutdown(wait=True, cancel_futures=True)
+
+
+app = FastAPI(title="PerovSegNet", lifespan=lifespan)
+
+
+async def _read_upload(upload: UploadFile) -> bytes:
+    data = await upload.read()
+    try:
+        validate_upload(SimpleNamespace(size=len(data), type=upload.content_type))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"{upload.filename}: {e}")
+    return data
+
+
+async def _segment(data: bytes, material_selection: str) -> dict:
+    if material_selection not in MATERIAL_SELECTIONS:
+        raise HTTPException(status_code=400, detail=f"Invalid material_selection: {material_selection}")
+
+    async with app.state.slots:
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(
+                app.state.pool, _segment_payload, data, material_selection
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+
+
+def _to_json(file_name: str, payload: dict) -> dict:
+    return {
+        "file_name": file_name,
+        "material_percentage": payload["material_percentage"],
+        "width": payload["width"],
+        "height": payload["height"],
+        "mask_png": base64.b64encode(payload["mask_png"]).decode("ascii"),
+    }
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+
+@app.post("/segment")
+async def segment(
+    file: UploadFile = File(...),
+    material_selection: str = Form("auto"),
+    format: str = Query("json", pattern="^(json|png)$"),
+):
+    """
+    Segments one image. `format=json` returns the percentage with a base64 1-bit
+    PNG mask; `format=png` returns the mask PNG itself with the percentage in
+    the X-Material-Percentage header.
+    """
+    data = await _read_upload(file)
+    payload = await _segment(data, material_selection)
+
+    if format == "png":
+        return Response(
+            content=payload["mask_png"],
+            media_type="image/png",
+            headers={"X-Material-Percentage": str(payload["material_percentage"])},
+        )
+    return _to_json(file.filename, payload)
+
+
+@app.post("/segment/batch")
+async def segment_batch(
+    files: List[UploadFile] = File(...),
+    material_selection: str = Form("auto"),
+):
+    """Segments several images concurrently; failures are reported per image."""
+    if len(files) > AppConfig.get('API_MAX_BATCH'):
+        raise HTTPException(status_code=413, detail="Too many images in one batch")
+
+    async def run_one(upload: UploadFile) -> dict:
+        try:
+            payload = await _segment(await _read_upload(upload), material_selection)
+            return _to_json(upload.filename, payload)
+        except HTTPException as e:
+            return {"file_name": upload.filename, "error": e.detail}
+        except Exception as e:
+            logger.exception(f"Batch item failed: {upload.filename}")
+            return {"file_name": upload.filename, "error": str(e)}
+
+    results = await asyncio.gather(*(run_one(upload) for upload in files))
+    return {"results": results}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        app,
+        host=AppConfig.get('API_HOST'),
+        port=AppConfig.get('API_PORT'),
+        loop="uvloop",
+    )
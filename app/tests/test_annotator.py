@@ -0,0 +1,155 @@
+import os
+import cv2
+import json
+import pytest
+import importlib.util
+import numpy as np
+from pathlib import Path
+
+ANNOTATOR_PATH = Path(__file__).resolve().parents[2] / "Automated annotations" / "annotator.py"
+_spec = importlib.util.spec_from_file_location("annotator", ANNOTATOR_PATH)
+annotator = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(annotator)
+
+
+def write_image(path, seed: int, size=(48, 64)):
+    """Dark background with a few bright rectangles, saved as PNG."""
+    rng = np.random.default_rng(seed)
+    image = np.full(size + (3,), 50, dtype=np.int16)
+    for _ in range(3):
+        y, x = rng.integers(0, size[0] - 12), rng.integers(0, size[1] - 12)
+        image[y:y + rng.integers(6, 12), x:x + rng.integers(6, 12)] = 190
+    image = (image + rng.integers(-10, 10, image.shape)).clip(0, 255).astype(np.uint8)
+    cv2.imwrite(str(path), image)
+    return path
+
+
+@pytest.fixture
+def image_folder(tmp_path):
+    folder = tmp_path / "images"
+    folder.mkdir()
+    for seed, name in enumerate(("a.png", "b.png", "c.png")):
+        write_image(folder / name, seed)
+    return folder
+
+
+def legacy_polygons(mask, image_id):
+    """Contour tracing of the original per-pixel implementation."""
+    annotations = []
+    for cat_id in [1, 2]:
+        cat_mask = (mask == cat_id).astype(np.uint8) * 255
+        contours, _ = cv2.findContours(cat_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        for cnt in contours:
+            if cv2.contourArea(cnt) < 10:
+                continue
+            segmentation = cnt.flatten().tolist()
+            if len(segmentation) < 6:
+                continue
+            annotations.append({"image_id": image_id, "category_id": cat_id,
+                                "bbox": list(cv2.boundingRect(cnt)), "area": cv2.contourArea(cnt),
+                                "segmentation": [segmentation], "iscrowd": 0})
+    return annotations
+
+
+def test_vectorized_segmenter_matches_loops(image_folder):
+    segmenter = annotator.ImageSegmenter(str(image_folder / "a.png"), num_clusters=2)
+    segmenter.run()
+    img, labels = segmenter.img_rgb, segmenter.labels
+
+    segmented = np.array([segmenter.centroids[label] for label in labels]).reshape(img.shape).astype(np.uint8)
+    assert np.array_equal(segmenter.segmented_img, segmented)
+
+    labels_2d = labels.reshape(img.shape[:2])
+    for i, cluster_img in enumerate(segmenter.cluster_images):
+        expected = np.zeros_like(img)
+        expected[labels_2d == i] = img[labels_2d == i]
+        assert np.array_equal(cluster_img, expected)
+
+    mask = np.zeros_like(labels_2d, dtype=np.uint8)
+    for i in range(segmenter.num_clusters):
+        mask[labels_2d == i] = 1 if segmenter.semantic_labels[i] == "background" else 2
+    assert np.array_equal(segmenter.generate_semantic_segmentation_mask(), mask)
+
+    polygons = segmenter.get_polygon_annotations(7)
+    assert polygons and [dict(a, bbox=list(a["bbox"])) for a in polygons] == legacy_polygons(mask, 7)
+
+
+def test_rle_counts_match_pycocotools():
+    mask = np.zeros((6, 8), dtype=bool)
+    mask[1:4, 2:6] = True
+    mask[5, 0] = mask[0, 7] = True
+    counts = annotator.rle_counts(mask)
+    assert counts.tolist() == [5, 1, 7, 3, 3, 3, 3, 3, 3, 3, 8, 1, 5]
+    assert annotator.rle_counts_to_string(counts) == "5172L000005NM"
+    assert annotator.rle_counts_to_string(annotator.rle_counts(np.ones((2, 2), dtype=bool))) == "04"
+    # Runs above 31 pixels span several 5-bit groups
+    assert annotator.rle_counts_to_string([203, 34, 6, 34]) == "[6R160"
+
+
+def test_stream_writer_output_is_coco_with_stable_ids(image_folder, tmp_path):
+    output = tmp_path / "coco.json"
+    annotator.process_folder(str(image_folder), str(output), workers=1, indent=None)
+    with open(output) as f:
+        coco = json.load(f)
+
+    assert set(coco) == {"info", "licenses", "images", "annotations", "categories"}
+    assert [image["id"] for image in coco["images"]] == [1, 2, 3]
+    assert [image["file_name"] for image in coco["images"]] == ["a.png", "b.png", "c.png"]
+    assert [ann["id"] for ann in coco["annotations"]] == list(range(1, len(coco["annotations"]) + 1))
+    assert {ann["image_id"] for ann in coco["annotations"]} == {1, 2, 3}
+    assert not os.path.exists(str(output) + ".images.part")
+
+    # An interrupted run resumed later produces the same document
+    resumed = tmp_path / "resumed.json"
+    with pytest.raises(RuntimeError):
+        with annotator.CocoStreamWriter(str(resumed)) as writer:
+            writer.add_image(*annotator.annotate_image(str(image_folder / "a.png"), 1))
+            raise RuntimeError("interrupted")
+    annotator.process_folder(str(image_folder), str(resumed), workers=1, indent=None, resume=True)
+    with open(resumed) as f:
+        assert json.load(f) == coco
+
+
+def test_incremental_run_tracks_added_changed_and_removed_files(image_folder, tmp_path):
+    output = tmp_path / "coco.json"
+    manifest_path = str(output) + ".manifest.json"
+
+    def run(**kwargs):
+        annotator.process_folder(str(image_folder), str(output), workers=1, incremental=True, **kwargs)
+        with open(output) as f, open(manifest_path) as m:
+            return json.load(f), json.load(m)
+
+    first, manifest = run()
+    first_anns = {ann["id"]: ann for ann in first["annotations"]}
+    assert manifest["annotation_format"] == "polygon" and manifest["simplify_tolerance"] == 0.0
+    assert {name: record["image_id"] for name, record in manifest["files"].items()} == \
+        {"a.png": 1, "b.png": 2, "c.png": 3}
+
+    write_image(image_folder / "b.png", seed=10)
+    write_image(image_folder / "d.png", seed=11)
+    os.remove(image_folder / "c.png")
+    second, manifest = run()
+
+    ids = {image["file_name"]: image["id"] for image in second["images"]}
+    assert ids == {"a.png": 1, "b.png": 2, "d.png": 4}
+    assert {name: record["image_id"] for name, record in manifest["files"].items()} == ids
+    assert manifest["files"]["b.png"]["sha256"] == annotator.file_sha256(str(image_folder / "b.png"))
+    # Unchanged entries are carried over as they were, new ones never reuse an id
+    for ann in second["annotations"]:
+        if ann["image_id"] == 1:
+            assert first_anns[ann["id"]] == ann
+        else:
+            assert ann["id"] > max(first_anns)
+    assert manifest["next_image_id"] == 5
+    assert manifest["next_ann_id"] == max(ann["id"] for ann in second["annotations"]) + 1
+    assert not os.path.exists(str(output) + ".images.part.prev")
+
+    # Nothing changed: the output is left as it is
+    assert run()[0] == second
+
+    # Other settings re-annotate every image under the same ids
+    third, manifest = run(annotation_format="rle")
+    assert {image["file_name"]: image["id"] for image in third["images"]} == ids
+    assert all(isinstance(ann["segmentation"], dict) for ann in third["annotations"])
+    assert min(ann["id"] for ann in third["annotations"]) > max(ann["id"] for ann in second["annotations"])
+    assert manifest["annotation_format"] == "rle"
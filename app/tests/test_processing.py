@@ -1,20 +1,441 @@
+import io
+import os
+import sys
+import csv
+import sqlite3
+import zipfile
+import threading
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
 import pytest
 import numpy as np
+from sklearn.cluster import KMeans
+
+from config import AppConfig
+from processing.batch import coverage_csv, masks_zip, process_upload
+from processing.cache import ResultCache
+from processing.clustering import (
+    fit_kmeans, gray_histogram, histogram_kmeans_1d, two_means_init, unique_colors, weighted_color_kmeans,
+)
+from processing.image_io import decode_image
 from processing.image_processor import ImageProcessor
+from processing.labels import PackedLabels, LABEL_BACKGROUND, LABEL_REJECTED
+from processing.model import Segmenter, SegmentationResult
+from processing.persistence import OUTPUT_FORMATS, WriteBehindQueue, encode_output
+from processing.security import save_segmented_image
+from processing.sequence import iter_frames, segment_sequence, SequenceSegmenter
+from processing.session import ClusteringSession
+from processing.store import ResultStore
+from processing.tiled import TiledSegmenter
+
+
+def phase_image(rng, shape, noise=10, background=50, phases=(150, 200)):
+    """Background plus a material made of two phases the second pass separates."""
+    phase = rng.random(shape + (1,))
+    image = np.select([phase < 0.15, phase < 0.3], list(phases), background).astype(np.int16)
+    return (image + rng.integers(-noise, noise, shape + (3,))).clip(0, 255).astype(np.uint8)
+
 
 @pytest.fixture
 def sample_image():
     return np.random.randint(0, 255, (256, 256, 3), dtype=np.uint8)
 
 def test_image_processing(sample_image):
-    processor = ImageProcessor()
-    result, percentage = processor.process_image(sample_image)
+    processor = ImageProcessor(sample_image)
+    result, percentage = processor()
     
     assert result.shape == sample_image.shape
     assert 0 <= percentage <= 100
     assert np.any(result != 0)
 
 def test_invalid_input():
-    processor = ImageProcessor()
     with pytest.raises(ValueError):
-        processor.process_image(b'invalid_data')
\ No newline at end of file
+        ImageProcessor(b'invalid_data')
+
+
+def test_empty_material_raises_value_error():
+    uniform = np.full((40, 50, 3), 120, dtype=np.uint8)
+    with pytest.raises(ValueError, match="material pixels"):
+        Segmenter(uniform, 'auto', headless=True).segment()
+    with pytest.raises(ValueError):
+        two_means_init(np.empty((0, 3)))
+    with pytest.raises(ValueError):
+        fit_kmeans(KMeans(n_clusters=2, n_init=1), np.zeros((1, 3)))
+
+
+def test_decode_sources_agree(sample_image, tmp_path):
+    ok, encoded = cv2.imencode(".png", cv2.cvtColor(sample_image, cv2.COLOR_RGB2BGR))
+    assert ok
+    path = tmp_path / "sample.png"
+    path.write_bytes(encoded.tobytes())
+
+    for source in (sample_image, encoded.tobytes(), io.BytesIO(encoded.tobytes()), str(path)):
+        rgb, gray = decode_image(source)
+        assert np.array_equal(rgb, sample_image)
+        assert gray.shape == sample_image.shape[:2]
+
+def test_histogram_first_pass_matches_kmeans():
+    rng = np.random.default_rng(0)
+    gray = np.concatenate([
+        rng.normal(70, 12, 6000), rng.normal(170, 20, 3000)
+    ]).clip(0, 255).astype(np.uint8)
+
+    lut, centers, counts = histogram_kmeans_1d(gray_histogram(gray))
+    labels = lut[gray]
+
+    kmeans = KMeans(n_clusters=2, n_init=10, random_state=42).fit(gray.reshape(-1, 1))
+    expected = kmeans.labels_ == np.argmax(kmeans.cluster_centers_.ravel())
+
+    assert np.array_equal(labels == 1, expected)
+    assert np.allclose(np.sort(centers.ravel()), np.sort(kmeans.cluster_centers_.ravel()), atol=0.1)
+    assert counts.sum() == gray.size
+
+
+def test_weighted_unique_colors_matches_dense_fit():
+    rng = np.random.default_rng(1)
+    base = rng.choice([40, 200], size=(5000, 1)).astype(np.int16)
+    pixels = (base + rng.integers(-10, 10, size=(5000, 3))).clip(0, 255).astype(np.uint8)
+
+    palette, inverse, counts = unique_colors(pixels)
+    assert np.array_equal(palette[inverse].astype(np.uint8), pixels)
+    assert counts.sum() == len(pixels)
+
+    weighted = KMeans(n_clusters=2, n_init=10, random_state=42)
+    labels = weighted_color_kmeans(weighted, pixels)
+    dense = KMeans(n_clusters=2, n_init=10, random_state=42).fit(pixels)
+
+    bright = labels == np.argmax(weighted.cluster_centers_.sum(axis=1))
+    expected = dense.labels_ == np.argmax(dense.cluster_centers_.sum(axis=1))
+    assert np.array_equal(bright, expected)
+
+    quantized, _, _ = unique_colors(pixels, color_bits=4)
+    assert len(quantized) <= len(palette)
+
+
+def test_result_cache_hit_and_eviction(sample_image):
+    # Room for one result: two bit planes of the image
+    cache = ResultCache(max_bytes=sample_image.shape[0] * sample_image.shape[1] // 4)
+    first = ImageProcessor(sample_image, cache=cache)
+    result, percentage = first()
+    assert first.cache_key in cache
+
+    second = ImageProcessor(sample_image.copy(), cache=cache)
+    second.segmenter.segment = None  # a cache hit must not run the clustering again
+    cached_result, cached_percentage = second()
+    assert np.array_equal(cached_result, result)
+    assert cached_percentage == percentage
+
+    # The app's 'auto' mode is the brighter cluster and shares its results
+    bright = ImageProcessor(sample_image, material_selection='bright', cache=cache)
+    assert bright.cache_key == first.cache_key
+
+    other = ImageProcessor(sample_image, material_selection='dark', cache=cache)
+    other()
+    assert other.cache_key in cache
+    assert first.cache_key not in cache
+    assert cache.current_bytes <= cache.max_bytes
+
+
+def test_headless_segmenter_returns_arrays(sample_image, tmp_path):
+    segmenter = Segmenter(sample_image, headless=True, save_dir=str(tmp_path))
+    result = segmenter()
+
+    assert isinstance(result, SegmentationResult)
+    assert result.label_map.shape == sample_image.shape[:2]
+    assert result.label_map.dtype == np.uint8
+    assert result.second_centers.shape == (2, 3)
+    assert (tmp_path / "image_mask.png").exists()
+    assert "matplotlib.pyplot" not in sys.modules
+
+
+def test_tiled_segmenter_matches_in_memory(sample_image, tmp_path):
+    source_path = tmp_path / "mosaic.npy"
+    np.save(source_path, sample_image)
+    output_path = tmp_path / "labels.npy"
+
+    tiled = TiledSegmenter(str(source_path), tile_size=100, sample_size=sample_image.size)
+    result = tiled(output_path=str(output_path))
+    expected = Segmenter(sample_image).segment()
+
+    labels = np.load(output_path)
+    assert np.array_equal(labels, expected.label_map)
+    assert result.material_percentage == pytest.approx(expected.material_percentage)
+    assert sum(tiled.label_counts.values()) == labels.size
+
+
+def test_subsample_fit_stays_close_to_full_fit():
+    rng = np.random.default_rng(3)
+    image = np.where(rng.random((300, 400, 1)) < 0.3, 190, 60).astype(np.int16)
+    image = (image + rng.integers(-25, 25, (300, 400, 3))).clip(0, 255).astype(np.uint8)
+
+    for first_pass in ('histogram', 'kmeans'):
+        segmenter = Segmenter(image, first_pass=first_pass, fit_sample=5_000, headless=True)
+        result = segmenter()
+        report = segmenter.coverage_deviation(result)
+
+        assert result.label_map.shape == image.shape[:2]
+        assert abs(report['percentage_deviation']) < 1.0
+        assert report['label_agreement'] > 0.98
+
+    # The exact histogram pass is never subsampled
+    sampled = Segmenter(image, fit_sample=5_000, headless=True)()
+    full = Segmenter(image, headless=True)()
+    assert sampled.material_percentage == full.material_percentage
+
+    # The full-fit reference uses the same initialization
+    restarts = Segmenter(image, fit_sample=5_000, init='k-means++', threads=2, headless=True)
+    assert restarts.coverage_deviation()['label_agreement'] > 0.98
+
+
+def test_stage_profile_records_pipeline_stages(sample_image, monkeypatch):
+    processor = ImageProcessor(sample_image, cache=ResultCache(0))
+    result, percentage, records = processor(return_profile=True)
+
+    stages = [record['stage'] for record in records]
+    assert stages == ['decode', 'cache_key', 'first_pass', 'masks', 'second_pass', 'pack', 'composite']
+    assert all(record['seconds'] >= 0 for record in records)
+    assert all(record['allocated_bytes'] is None for record in records)
+
+    monkeypatch.setitem(AppConfig.DEFAULTS, 'PROFILE_MEMORY', True)
+    processor = ImageProcessor(sample_image, cache=ResultCache(0))
+    result, percentage, records = processor(return_profile=True)
+    assert next(r for r in records if r['stage'] == 'composite')['allocated_bytes'] >= result.nbytes
+
+    # Concurrent profilers share tracemalloc: stages either measure alone or skip
+    with ThreadPoolExecutor(4) as executor:
+        runs = list(executor.map(
+            lambda _: ImageProcessor(sample_image, cache=ResultCache(0))(return_profile=True)[2], range(8)
+        ))
+    for records in runs:
+        assert all(r['allocated_bytes'] is None or r['allocated_bytes'] >= 0 for r in records)
+
+
+def test_clustering_session_warm_starts_and_falls_back():
+    rng = np.random.default_rng(4)
+
+    def acquisition(dark, bright):
+        return phase_image(rng, (120, 160), background=dark, phases=(bright, bright + 50))
+
+    session = ClusteringSession()
+    for _ in range(3):
+        image = acquisition(50, 150)
+        warm = Segmenter(image, first_pass='kmeans', headless=True, session=session)()
+        cold = Segmenter(image, first_pass='kmeans', headless=True)()
+        assert np.array_equal(warm.label_map, cold.label_map)
+    assert session.cold_fits == 2 and session.warm_fits == 4
+
+    # A different acquisition moves the centers too far and forces a cold fit
+    Segmenter(acquisition(10, 100), first_pass='kmeans', headless=True, session=session)()
+    assert session.cold_fits == 4
+
+    # A background refinement and a new upload may share the session
+    images = [acquisition(10, 100) for _ in range(4)]
+    fits = session.cold_fits + session.warm_fits
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        results = list(pool.map(
+            lambda image: Segmenter(image, first_pass='kmeans', headless=True, session=session)(), images
+        ))
+    for image, result in zip(images, results):
+        assert np.array_equal(result.label_map, Segmenter(image, first_pass='kmeans', headless=True)().label_map)
+    assert session.cold_fits + session.warm_fits == fits + 2 * len(images)
+
+
+def test_seeded_init_matches_restarts():
+    rng = np.random.default_rng(6)
+    image = phase_image(rng, (120, 160), noise=25)
+
+    for first_pass in ('histogram', 'kmeans'):
+        seeded = Segmenter(image, first_pass=first_pass, headless=True)
+        restarts = Segmenter(image, first_pass=first_pass, init='k-means++', threads=2, headless=True)
+        assert np.array_equal(seeded.segment().label_map, restarts.segment().label_map)
+        assert seeded.second_kmeans.n_iter_ <= restarts.second_kmeans.n_iter_
+
+    # Concurrent restarts keep the best run and expose it through the estimator
+    blobs = np.concatenate([rng.normal(center, 1.0, (200, 2)) for center in (0, 10, 20)])
+    parallel = fit_kmeans(KMeans(n_clusters=3, n_init=4, random_state=0), blobs, threads=2)
+    serial = KMeans(n_clusters=3, n_init=4, random_state=0).fit(blobs)
+    assert parallel.labels_.shape == (len(blobs),)
+    assert np.isclose(parallel.inertia_, serial.inertia_)
+    assert np.array_equal(parallel.predict(blobs), parallel.labels_)
+    assert parallel.get_params()['n_init'] == 4
+
+
+def test_sequence_recomputes_only_changed_blocks(tmp_path):
+    frame = phase_image(np.random.default_rng(5), (256, 384))
+
+    grown = frame.copy()
+    grown[40:56, 64:96] = 200  # material grows in one region
+    frames = [(0.0, frame), (0.5, frame.copy()), (1.0, grown)]
+
+    results = list(SequenceSegmenter(pixel_tolerance=0, block_size=16)(frames))
+    assert [r.refit for r in results] == [True, False, False]
+    assert np.array_equal(results[0].label_map, Segmenter(frame).segment().label_map)
+    assert results[1].recomputed_fraction == 0
+    assert 0 < results[2].recomputed_fraction < 0.05
+    assert results[2].material_percentage > results[0].material_percentage
+
+    masks_path = tmp_path / "masks.npz"
+    series = segment_sequence(np.stack([frame, grown]), masks_path=str(masks_path),
+                              coverage_path=str(tmp_path / "coverage.csv"), fps=2)
+    assert [record['time_s'] for record in series] == [0.0, 0.5]
+    with np.load(masks_path) as stack:
+        assert np.array_equal(stack['frame_000000'], results[0].label_map)
+        assert np.array_equal(stack['frame_000001'], results[2].label_map)
+
+    # Multi-page TIFFs are decoded page by page
+    tiff_path = str(tmp_path / "stack.tif")
+    assert cv2.imwritemulti(tiff_path, [cv2.cvtColor(f, cv2.COLOR_RGB2BGR) for f in (frame, grown)])
+    pages = iter_frames(tiff_path, fps=2)
+    assert next(pages)[0] == 0.0
+    assert [np.array_equal(page, f) for (_, page), f in zip(pages, [grown])] == [True]
+
+
+def test_packed_labels_round_trip(tmp_path):
+    rng = np.random.default_rng(8)
+    label_map = rng.choice(np.array([0, 1, 2], dtype=np.uint8), size=(37, 53))  # not a multiple of 8
+    packed = PackedLabels.pack(label_map)
+
+    assert packed.nbytes <= label_map.nbytes // 4 + 2
+    assert np.array_equal(packed.unpack(), label_map)
+    assert np.array_equal(packed.material_mask(), label_map != LABEL_BACKGROUND)
+    assert np.array_equal(packed.rejected_mask(), label_map == LABEL_REJECTED)
+
+    packed.save(str(tmp_path / "labels.npz"))
+    assert np.array_equal(PackedLabels.load(str(tmp_path / "labels.npz")).unpack(), label_map)
+
+    store = ResultStore(str(tmp_path / "store"))
+    store.put("ab" * 32, "hash", {}, packed, 12.5)
+    labels, percentage = store.get("ab" * 32)
+    assert np.array_equal(labels.unpack(), label_map) and percentage == 12.5
+
+
+def test_result_store_serves_repeats_and_history(sample_image, tmp_path, monkeypatch):
+    monkeypatch.setitem(AppConfig.DEFAULTS, 'SAVE_DIR', str(tmp_path / "predictions"))
+    store = ResultStore(str(tmp_path / "store"))
+
+    first = ImageProcessor(sample_image, cache=ResultCache(0), store=store)
+    result, percentage = first()
+    saved = save_segmented_image(result, "a.png", percentage, first.cache_key, store)
+
+    # A new process would start with an empty cache: the store serves the result
+    repeat = ImageProcessor(sample_image, cache=ResultCache(0), store=ResultStore(store.root))
+    repeat.segmenter.segment = None
+    repeat_result, repeat_percentage = repeat()
+    assert np.array_equal(repeat_result, result)
+    assert repeat_percentage == pytest.approx(percentage)
+
+    assert save_segmented_image(repeat_result, "a.png", repeat_percentage, repeat.cache_key, store) == saved
+    assert len(list((tmp_path / "predictions").glob("*.png"))) == 1
+
+    history = store.history(file_name="a.png")
+    assert len(history) == 2
+    assert history[0]["image_hash"] == first.image_hash
+    assert history[0]["params"]["material_selection"] == "bright"
+
+
+def test_batch_collects_masks_and_coverage(sample_image, tmp_path, monkeypatch):
+    monkeypatch.setitem(AppConfig.DEFAULTS, 'SAVE_DIR', str(tmp_path / "predictions"))
+    ok, png = cv2.imencode(".png", sample_image)
+    uploads = [("a.png", png.tobytes()), ("b.png", png.tobytes()), ("broken.png", b"not an image")]
+    store = ResultStore(str(tmp_path / "store"))
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        items = list(pool.map(lambda upload: process_upload(upload[1], upload[0], store=store, threads=1), uploads))
+
+    assert [item.error is None for item in items] == [True, True, False]
+    assert items[0].material_percentage == items[1].material_percentage
+
+    with zipfile.ZipFile(io.BytesIO(masks_zip(items))) as archive:
+        assert archive.namelist() == ['a_mask.png', 'b_mask.png']
+        mask = cv2.imdecode(np.frombuffer(archive.read('a_mask.png'), np.uint8), cv2.IMREAD_GRAYSCALE)
+    assert mask.shape == sample_image.shape[:2]
+
+    rows = list(csv.DictReader(io.StringIO(coverage_csv(items))))
+    assert [row['file_name'] for row in rows] == ['a.png', 'b.png', 'broken.png']
+    assert float(rows[0]['coverage_percentage']) == pytest.approx(100 - items[0].material_percentage)
+    assert rows[2]['error'] and not rows[2]['material_percentage']
+
+
+def test_preview_estimates_full_resolution_coverage():
+    image = phase_image(np.random.default_rng(7), (768, 1024), noise=20)
+
+    processor = ImageProcessor(image, cache=ResultCache(1 << 30))
+    preview_original, preview_result, preview_percentage = processor.preview(max_side=256)
+    assert max(preview_original.shape[:2]) <= 256
+    assert preview_result.shape == preview_original.shape
+    assert not processor.has_result()
+
+    _, percentage = processor()
+    assert abs(preview_percentage - percentage) < 1.0
+    assert processor.has_result()
+
+
+def test_write_behind_saves_encoded_output(sample_image, tmp_path, monkeypatch):
+    monkeypatch.setitem(AppConfig.DEFAULTS, 'SAVE_DIR', str(tmp_path / "predictions"))
+    processor = ImageProcessor(sample_image, cache=ResultCache(0))
+    result, percentage = processor()
+
+    for output_format in OUTPUT_FORMATS:
+        encoded = encode_output(result, processor.labels, output_format)
+        decoded = cv2.imdecode(np.frombuffer(encoded.data, np.uint8), cv2.IMREAD_UNCHANGED)
+        if output_format == 'mask':
+            assert np.array_equal(decoded > 0, processor.labels.material_mask())
+        else:
+            # Both overlay formats are lossless
+            assert np.array_equal(cv2.cvtColor(decoded, cv2.COLOR_BGR2RGB), result)
+
+    writer = WriteBehindQueue(max_pending=1)
+    paths = [
+        save_segmented_image(result, f"{index}.png", percentage, encoded=encoded, writer=writer)
+        for index in range(3)
+    ]
+    writer.close()  # flushes the queue, as at shutdown
+    for path in paths:
+        assert path.endswith(".png")
+        with open(path, "rb") as f:
+            assert f.read() == encoded.data
+
+
+def test_write_behind_dedups_pending_writes(sample_image, tmp_path, monkeypatch):
+    monkeypatch.setitem(AppConfig.DEFAULTS, 'SAVE_DIR', str(tmp_path / "predictions"))
+    store = ResultStore(str(tmp_path / "store"))
+    writer = WriteBehindQueue(max_pending=8)
+    gate = threading.Event()
+    writer.submit(gate.wait)  # holds the queue so that the writes below stay pending
+
+    processor = ImageProcessor(sample_image, cache=ResultCache(0), store=store, writer=writer)
+    result, percentage = processor()
+    assert not store.contains(processor.cache_key)
+
+    png = encode_output(result, processor.labels, 'png')
+    mask = encode_output(result, processor.labels, 'mask')
+    try:
+        first = save_segmented_image(result, "a.png", percentage, processor.cache_key, store, png, writer)
+        again = save_segmented_image(result, "a.png", percentage, processor.cache_key, store, png, writer)
+        other_format = save_segmented_image(result, "a.png", percentage, processor.cache_key, store, mask, writer)
+        assert again == first and other_format != first
+        assert not os.path.exists(first)
+    finally:
+        gate.set()
+    writer.flush()
+    assert store.contains(processor.cache_key)
+    assert store.saved_path(processor.cache_key, 'png') == first
+    assert store.saved_path(processor.cache_key, 'mask') == other_format
+    assert len(list((tmp_path / "predictions").glob("*.png"))) == 2
+    assert len(store.history(file_name="a.png")) == 3
+
+    failed, _ = writer.submit(lambda: open(tmp_path / "missing" / "file", "wb"))
+    writer.close()
+    assert isinstance(failed.exception(), OSError)
+
+    # Stores created before the output format was recorded are migrated
+    legacy_root = tmp_path / "legacy"
+    legacy_root.mkdir()
+    with closing(sqlite3.connect(legacy_root / "index.sqlite")) as conn, conn:
+        conn.execute("CREATE TABLE runs (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, "
+                     "file_name TEXT NOT NULL, saved_path TEXT, created_at TEXT NOT NULL)")
+    legacy = ResultStore(str(legacy_root))
+    legacy.record_run("key", "a.png", first, 'png')
+    assert legacy.saved_path("key", 'png') == first
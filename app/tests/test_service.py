@@ -0,0 +1,44 @@
+import base64
+import cv2
+import numpy as np
+import pytest
+
+pytest.importorskip("httpx")
+from fastapi.testclient import TestClient
+
+from config import AppConfig
+from service import app
+
+
+@pytest.fixture(autouse=True)
+def isolated_store(tmp_path, monkeypatch):
+    monkeypatch.setitem(AppConfig.DEFAULTS, 'RESULT_STORE_DIR', str(tmp_path / "store"))
+
+
+@pytest.fixture
+def png_bytes():
+    image = np.random.default_rng(0).integers(0, 255, (64, 80, 3), dtype=np.uint8)
+    ok, encoded = cv2.imencode(".png", image)
+    assert ok
+    return encoded.tobytes()
+
+
+def test_segment_and_batch(png_bytes):
+    with TestClient(app) as client:
+        response = client.post("/segment", files={"file": ("a.png", png_bytes, "image/png")})
+        assert response.status_code == 200
+        body = response.json()
+        assert 0 <= body["material_percentage"] <= 100
+        mask = cv2.imdecode(np.frombuffer(base64.b64decode(body["mask_png"]), np.uint8), 0)
+        assert mask.shape == (64, 80)
+
+        response = client.post(
+            "/segment/batch",
+            files=[
+                ("files", ("a.png", png_bytes, "image/png")),
+                ("files", ("b.txt", b"not an image", "text/plain")),
+            ],
+        )
+        results = response.json()["results"]
+        assert results[0]["material_percentage"] == body["material_percentage"]
+        assert "error" in results[1]
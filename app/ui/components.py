@@ -1,8 +1,6 @@
 import streamlit as st
 import numpy as np
-from typing import Optional, Tuple
-from PIL import Image
-import io
+from typing import List, Sequence, Tuple
 
 def apply_custom_css():
     """Apply minimal custom CSS"""
@@ -19,15 +17,16 @@ def render_header():
     """Render simple app header"""
     st.title("PerovSegNet - Material Segmentation")
 
-def file_uploader() -> Tuple[Optional[bytes], str]:
-    """File upload component with material selection"""
+def file_uploader() -> Tuple[List, str]:
+    """File upload component (one or several images) with material selection"""
     col1, col2 = st.columns([2, 1])
 
     with col1:
-        uploaded_file = st.file_uploader(
-            "Choose an image file",
+        uploaded_files = st.file_uploader(
+            "Choose image files",
             type=["png", "jpg", "jpeg"],
-            help="Supported formats: PNG, JPG, JPEG (Max: 10MB)"
+            accept_multiple_files=True,
+            help="Supported formats: PNG, JPG, JPEG (Max: 10MB each). Several images are analyzed together."
         )
 
     with col2:
@@ -42,7 +41,7 @@ def file_uploader() -> Tuple[Optional[bytes], str]:
             """
         )
 
-    return uploaded_file, material_selection
+    return uploaded_files or [], material_selection
 
 def display_results(original: np.ndarray, result: np.ndarray, percentage: float):
     """Display results in simple layout"""
@@ -64,17 +63,60 @@ def display_results(original: np.ndarray, result: np.ndarray, percentage: float)
         st.subheader("Segmented Material")
         st.image(result, width='stretch')
 
-def create_download_button(result: np.ndarray, filename: str, percentage: float):
-    """Create download button for segmented image"""
-    result_pil = Image.fromarray(result.astype('uint8'))
+def display_stage_profile(records: list):
+    """Show per-stage timings and allocations in a collapsed expander"""
+    with st.expander("Processing details"):
+        st.table([
+            {
+                "Stage": record["stage"],
+                "Time (ms)": f"{record['seconds'] * 1000:.1f}",
+                "Allocated (MB)": "-" if record["allocated_bytes"] is None
+                else f"{record['allocated_bytes'] / 2**20:.1f}",
+            }
+            for record in records
+        ])
+        st.caption(f"Total: {sum(r['seconds'] for r in records) * 1000:.1f} ms")
 
-    buf = io.BytesIO()
-    result_pil.save(buf, format='PNG')
-    byte_im = buf.getvalue()
+def display_batch_status(container, file_names: Sequence[str], items: Sequence):
+    """Per-image status table, redrawn in `container` as images complete"""
+    rows = []
+    for name, item in zip(file_names, items):
+        row = {"Image": name, "Status": "Queued", "Material Coverage (%)": None, "Time (s)": None}
+        if item is not None:
+            row["Status"] = f"Failed: {item.error}" if item.error else "Done"
+            row["Material Coverage (%)"] = item.coverage_percentage
+            row["Time (s)"] = item.seconds
+        rows.append(row)
+    container.dataframe(rows, hide_index=True, width='stretch')
 
+def create_batch_downloads(masks_zip: bytes, coverage_csv: str):
+    """Download buttons for the zip of masks and the coverage CSV of a batch"""
+    col1, col2 = st.columns(2)
+
+    with col1:
+        st.download_button(
+            label="Download Masks (ZIP)",
+            data=masks_zip,
+            file_name="segmented_masks.zip",
+            mime="application/zip",
+            on_click="ignore",
+        )
+
+    with col2:
+        st.download_button(
+            label="Download Coverage (CSV)",
+            data=coverage_csv,
+            file_name="coverage.csv",
+            mime="text/csv",
+            on_click="ignore",
+        )
+
+def create_download_button(encoded, filename: str, percentage: float):
+    """Create download button for the segmented image, already encoded as EncodedOutput"""
     st.download_button(
         label="Download Segmented Image",
-        data=byte_im,
-        file_name=f"{filename.split('.')[0]}_segmented_{percentage:.1f}pct.png",
-        mime="image/png"
+        data=encoded.data,
+        file_name=f"{filename.split('.')[0]}_segmented_{percentage:.1f}pct.{encoded.extension}",
+        mime=encoded.mime,
+        on_click="ignore",
     )
@@ -0,0 +1,302 @@
+"""
+Benchmarks for the segmentation and annotation hot paths.
+
+Every (case, resolution) pair runs in a fresh process on a synthetic
+perovskite-like grain image and reports wall time, peak RSS and throughput.
+Each case reports the median of its timed repeats together with their spread.
+Results are written as JSON and compared against a stored baseline; any
+regression beyond the tolerance and the measured noise makes the script exit
+with status 1. Timings only compare on the machine that recorded the baseline,
+so a baseline from another machine is reported but not enforced unless
+--strict is given; re-record it with --update-baseline on each machine.
+
+Usage:
+    python benchmarks/run_benchmarks.py                      # 1, 10 and 50 MP
+    python benchmarks/run_benchmarks.py --sizes 1 10 --cases segmenter image_processor
+    python benchmarks/run_benchmarks.py --update-baseline    # record a new baseline
+    python benchmarks/run_benchmarks.py --strict             # gate even on a foreign baseline
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import importlib.util
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import cv2
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_DIR = os.path.join(REPO_ROOT, "app")
+ANNOTATOR_PATH = os.path.join(REPO_ROOT, "Automated annotations", "annotator.py")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+
+def synthetic_grains(megapixels: float, seed: int = 0) -> np.ndarray:
+    """
+    Generates an RGB micrograph-like image: bright polycrystalline grains with
+    dark grain boundaries, darker pinholes exposing the substrate, and noise.
+    """
+    rng = np.random.default_rng(seed)
+    width = int(round(np.sqrt(megapixels * 1e6 * 4 / 3)))
+    height = int(round(megapixels * 1e6 / width))
+
+    # Grains: Voronoi cells around random seeds via a labelled distance transform
+    n_grains = max(16, int(megapixels * 1e6 / 2500))
+    seeds = np.full((height, width), 255, dtype=np.uint8)
+    seeds[rng.integers(0, height, n_grains), rng.integers(0, width, n_grains)] = 0
+    _, grain_ids = cv2.distanceTransformWithLabels(
+        seeds, cv2.DIST_L2, 3, labelType=cv2.DIST_LABEL_CCOMP
+    )
+
+    grain_levels = rng.integers(150, 215, size=grain_ids.max() + 1).astype(np.uint8)
+    gray = grain_levels[grain_ids]
+    del seeds
+
+    # Grain boundaries wherever the label changes between neighbours
+    boundary = np.zeros(gray.shape, dtype=bool)
+    boundary[1:, :] |= grain_ids[1:, :] != grain_ids[:-1, :]
+    boundary[:, 1:] |= grain_ids[:, 1:] != grain_ids[:, :-1]
+    del grain_ids
+    boundary = cv2.dilate(boundary.astype(np.uint8), np.ones((3, 3), np.uint8)).astype(bool)
+    gray[boundary] = 70
+    del boundary
+
+    # Pinholes
+    for _ in range(max(4, int(megapixels * 40))):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        cv2.circle(gray, center, int(rng.integers(4, 30)), 35, -1)
+
+    noise = rng.normal(0, 6, size=gray.shape).astype(np.int16)
+    gray = np.clip(gray.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+    del noise
+
+    # Slight warm tint so the RGB pass is not degenerate
+    tint = np.array([1.0, 0.96, 0.9], dtype=np.float32)
+    return np.clip(gray[..., np.newaxis] * tint, 0, 255).astype(np.uint8)
+
+
+def _load_annotator():
+    spec = importlib.util.spec_from_file_location("annotator", ANNOTATOR_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _write_png(image: np.ndarray, workdir: str) -> str:
+    path = os.path.join(workdir, "synthetic.png")
+    cv2.imwrite(path, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+    return path
+
+
+# Each case: setup(image, workdir) -> state (untimed), run(state) (timed)
+def _setup_segmenter(image, workdir):
+    from processing.model import Segmenter
+    return lambda: Segmenter(image, headless=True)()
+
+
+def _setup_image_processor(image, workdir):
+    from processing.cache import ResultCache
+    from processing.image_processor import ImageProcessor
+    # An empty cache budget forces a full run on every repeat
+    return lambda: ImageProcessor(image, cache=ResultCache(0))()
+
+
+def _setup_save(image, workdir):
+    from config import AppConfig
+    from processing.security import save_segmented_image
+    AppConfig.DEFAULTS['SAVE_DIR'] = workdir
+    return lambda: save_segmented_image(image, "synthetic.png", 42.0)
+
+
+def _setup_annotator_run(image, workdir):
+    annotator = _load_annotator()
+    path = _write_png(image, workdir)
+    return lambda: annotator.ImageSegmenter(path, num_clusters=2).run()
+
+
+def _setup_annotator_polygons(image, workdir):
+    annotator = _load_annotator()
+    segmenter = annotator.ImageSegmenter(_write_png(image, workdir), num_clusters=2)
+    segmenter.run()
+    return lambda: segmenter.get_polygon_annotations(image_id=1)
+
+
+CASES = {
+    "segmenter": _setup_segmenter,
+    "image_processor": _setup_image_processor,
+    "save_segmented_image": _setup_save,
+    "annotator_run": _setup_annotator_run,
+    "annotator_polygons": _setup_annotator_polygons,
+}
+
+
+def _reset_peak_rss() -> bool:
+    """Resets the kernel's peak-RSS counter (Linux only)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_bytes() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _run_case(case: str, megapixels: float, repeat: int) -> dict:
+    """Runs in a fresh process so the peak RSS belongs to this case only."""
+    # Silence the pipeline's progress prints
+    sys.stdout = open(os.devnull, "w")
+
+    image = synthetic_grains(megapixels)
+    with tempfile.TemporaryDirectory() as workdir:
+        run = CASES[case](image, workdir)
+        peak_reset = _reset_peak_rss()
+
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+
+    wall_time = float(np.median(times))
+    return {
+        "case": case,
+        "megapixels": megapixels,
+        "repeat": repeat,
+        "wall_time_s": round(wall_time, 4),
+        "wall_time_spread_s": round(max(times) - min(times), 4),
+        "peak_rss_mb": round(_peak_rss_bytes() / 2 ** 20, 1),
+        "peak_rss_includes_setup": not peak_reset,
+        "throughput_mp_s": round(image.shape[0] * image.shape[1] / 1e6 / wall_time, 3),
+    }
+
+
+def machine_info() -> dict:
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+    }
+
+
+# Differences below these are treated as noise regardless of the relative tolerance
+NOISE_FLOOR = {"wall_time_s": 0.05, "peak_rss_mb": 16.0}
+# Wall-time differences within this many repeat spreads (baseline + current) are noise too
+SPREAD_FACTOR = 2.0
+
+
+def noise_allowance(metric: str, result: dict, base: dict) -> float:
+    """Absolute difference below which `metric` is considered noise."""
+    if metric != "wall_time_s":
+        return NOISE_FLOOR[metric]
+    spread = result.get("wall_time_spread_s", 0.0) + base.get("wall_time_spread_s", 0.0)
+    return max(NOISE_FLOOR[metric], SPREAD_FACTOR * spread)
+
+
+def same_machine(baseline: dict, machine: dict) -> bool:
+    recorded = baseline.get("machine", {})
+    return all(recorded.get(key) == machine[key] for key in ("platform", "cpu_count"))
+
+
+def compare(results: list, baseline: dict, tolerance: float) -> list:
+    """
+    Returns human-readable regressions of wall time or peak RSS beyond both
+    `tolerance` and the noise allowance of the metric.
+    """
+    reference = {(r["case"], r["megapixels"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for result in results:
+        base = reference.get((result["case"], result["megapixels"]))
+        if base is None:
+            continue
+        for metric in ("wall_time_s", "peak_rss_mb"):
+            excess = result[metric] - base[metric]
+            if excess > base[metric] * tolerance and excess > noise_allowance(metric, result, base):
+                regressions.append(
+                    f"{result['case']} @ {result['megapixels']} MP: {metric} "
+                    f"{result[metric]} vs baseline {base[metric]} "
+                    f"(+{(result[metric] / base[metric] - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark segmentation and annotation hot paths.")
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 10, 50], help="Image sizes in megapixels.")
+    parser.add_argument("--cases", nargs="+", choices=sorted(CASES), default=list(CASES))
+    parser.add_argument("--repeat", type=int, default=7, help="Timed runs per case; the median is reported.")
+    parser.add_argument("--output", type=str, default="benchmark_results.json", help="JSON results file.")
+    parser.add_argument("--baseline", type=str, default=DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative slowdown / growth.")
+    parser.add_argument("--update-baseline", action="store_true", help="Store these results as the baseline.")
+    parser.add_argument("--strict", action="store_true",
+                        help="Fail on regressions even if the baseline was recorded on another machine.")
+    args = parser.parse_args()
+
+    results = []
+    for megapixels in args.sizes:
+        for case in args.cases:
+            # A fresh interpreter per case keeps peak RSS and warm caches independent
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+                result = pool.submit(_run_case, case, megapixels, args.repeat).result()
+            results.append(result)
+            print(f"{case:>22} {megapixels:>6g} MP  {result['wall_time_s']:>9.3f} s  "
+                  f"{result['peak_rss_mb']:>9.1f} MB  {result['throughput_mp_s']:>8.2f} MP/s")
+
+    report = {"machine": machine_info(), "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline updated: {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print("No baseline found; run with --update-baseline to create one.")
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    foreign = not same_machine(baseline, report["machine"])
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("\nPERFORMANCE REGRESSIONS:")
+        for line in regressions:
+            print(f"  - {line}")
+        if foreign and not args.strict:
+            print("The baseline was recorded on a different machine, so these are not enforced; "
+                  "re-record it here with --update-baseline or pass --strict.")
+            return
+        sys.exit(1)
+    print("No regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,46 @@
 """
 Launcher script for PerovSegNet desktop application.
 This script runs Streamlit directly (not as subprocess) for PyInstaller compatibility.
+
+Pass --startup-timing (or set PEROVSEGNET_STARTUP_TIMING=1) to print how long each
+startup phase takes; the first page render is reported in the app log.
 """
+import time
+
+LAUNCH_TIME = time.time()
+
 import sys
 import os
+import socket
 import webbrowser
-from threading import Timer
+from threading import Thread
 
 # Streamlit server port
 PORT = 8080
+SERVER_TIMEOUT = 120  # Seconds to wait for the server before opening the browser anyway
+
+
+def startup_log(message):
+    print(f"[startup {time.time() - LAUNCH_TIME:6.2f}s] {message}")
 
-def open_browser():
-    """Open browser after a delay."""
+
+def wait_for_server(timeout=SERVER_TIMEOUT):
+    """Polls the Streamlit port until it accepts connections. Returns True when it does."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("localhost", PORT), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def open_browser_when_ready(startup_timing=False):
+    """Open the browser as soon as the server is up."""
+    ready = wait_for_server()
+    if startup_timing:
+        startup_log("server accepting connections" if ready else "server not ready, opening browser anyway")
     webbrowser.open(f"http://localhost:{PORT}")
 
 def get_app_path():
@@ -26,6 +55,12 @@ def get_app_path():
     return os.path.join(base_path, "app", "main.py")
 
 def main():
+    startup_timing = "--startup-timing" in sys.argv or os.environ.get("PEROVSEGNET_STARTUP_TIMING") == "1"
+    if startup_timing:
+        # Read by app/main.py to log the time to the first rendered page
+        os.environ["PEROVSEGNET_LAUNCH_TIME"] = str(LAUNCH_TIME)
+        startup_log("launcher started")
+
     # Get the correct app path
     app_path = get_app_path()
 
@@ -46,17 +81,20 @@ def main():
     print("Starting PerovSegNet Desktop Application")
     print("="*60)
     print(f"\nApp will open at: http://localhost:{PORT}")
-    print("Browser will open automatically in 3 seconds...")
+    print("Browser will open automatically once the server is ready...")
     print("\nPress Ctrl+C to stop the application.\n")
     print("="*60 + "\n")
 
-    # Schedule browser to open after 3 seconds
-    Timer(3.0, open_browser).start()
+    # Open the browser once the server accepts connections
+    Thread(target=open_browser_when_ready, args=(startup_timing,), daemon=True).start()
 
     # Import and run Streamlit directly
     try:
         from streamlit.web import cli as stcli
 
+        if startup_timing:
+            startup_log("streamlit imported")
+
         # Set up Streamlit arguments
         sys.argv = [
             "streamlit",